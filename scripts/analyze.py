@@ -9,6 +9,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import spectral
 import numpy as np
+import multiprocessing
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger()
 
@@ -37,6 +38,36 @@ def padWindows(spectra, tally, mer):
         spectra.loc[index, mer] = [a/tally[index] for a in row[mer]]
     return spectra
 
+# Penalties of -P: comma separated values and LOW:HIGH:N ranges of N log-spaced values
+def parse_penalties(value):
+    penalties = []
+    for item in value.split(','):
+        if ':' in item:
+            low, high, count = item.split(':')
+            penalties += np.geomspace(float(low), float(high), int(count)).tolist()
+        else:
+            penalties.append(float(item))
+    if not penalties or min(penalties) <= 0:
+        raise ValueError(f"Penalties must be positive and at least one is needed, got {penalties}")
+    return sorted(set(penalties))
+
+# Number of segments of each sequence for each penalty of a getBreakpointPath result
+def penalty_curve(penalties, path):
+    rows = [[penalty, group[0], group[1], max(len(starts), 1)] for penalty, breakpoints in zip(penalties, path) for group, starts in breakpoints]
+    return pd.DataFrame(rows, columns=['Penalty', 'Library', 'Sequence', 'Segments'])
+
+# Writes the segment count curve of -P and, with an output prefix, the bins of each penalty
+def write_penalty_path(spectra, penalties, path, args, index, dim):
+    curve = penalty_curve(penalties, path)
+    if not args.output_prefix:
+        print(curve.groupby('Penalty')['Segments'].sum().to_string())
+        return
+    curve.to_csv(f"{args.output_prefix}_penalties.tsv", index=False, sep='\t')
+    for penalty, breakpoints in zip(penalties, path):
+        results = spectral.getBreakpointFrequencies(spectral.applyBreakpoints(spectra.copy(), breakpoints), args.frequency, index=index, dim=dim)
+        results.to_csv(f"{args.output_prefix}_p{penalty:g}_bins.tsv", index=False, sep='\t')
+        gffWriter(results, f"{args.output_prefix}_p{penalty:g}")
+
 def execute(args):
     if args.verbose:
         logger.setLevel(logging.INFO)
@@ -45,7 +76,19 @@ def execute(args):
         logging.error(f"Could not find input file '{args.input_tsv}'")
         exit()
 
-    spectra = pd.read_csv(args.input_tsv, delimiter='\t')
+    penalties = None
+    if args.penalties:
+        try:
+            penalties = parse_penalties(args.penalties)
+        except ValueError:
+            logging.error(f"Could not read penalties '{args.penalties}', expected positive values like 1e5,1e6 or ranges like 1e4:1e8:9")
+            exit()
+
+    try:
+        spectra = spectral.readSpectraResolution(args.input_tsv, args.resolution)
+    except ValueError as error:
+        logging.error(error)
+        exit()
     indexLength = 4
     spectraDimensions = len(spectra.columns) - indexLength
     if args.frequency:
@@ -53,19 +96,28 @@ def execute(args):
         if args.penalty > 1:
             args.penalty = 0.5
         spectra = spectral.countToFrequency(spectra, index=indexLength, dim=spectraDimensions)
-    breakpoints = spectral.getBreakpoints(spectra, penalty=args.penalty, min_size=args.size, index=indexLength, dim=spectraDimensions)
-    spectra = spectral.applyBreakpoints(spectra, breakpoints)
+    # sequences are fitted in worker processes with -t, largest first so one long sequence does not finish last
+    pool = multiprocessing.Pool(processes=args.threads) if args.threads > 1 else None
+    path = spectral.getBreakpointPath(spectra, penalties or [args.penalty], min_size=args.size, index=indexLength, dim=spectraDimensions, pool=pool,
+                                      backend=args.backend, coarse_factor=args.coarse_factor)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if penalties:
+        write_penalty_path(spectra, penalties, path, args, indexLength, spectraDimensions)
+        return
+    spectra = spectral.applyBreakpoints(spectra, path[0])
 
     if args.output_prefix:
-        spectra.to_csv(f"{args.output_prefix}.tsv", sep='\t', index=False)
+        spectral.writeSpectra(spectra, f"{args.output_prefix}.tsv")
 
-    spectraDimensions -= 1
     results = spectral.getBreakpointFrequencies(spectra, args.frequency, index=indexLength, dim=spectraDimensions)
     if args.output_prefix:
         results.to_csv(f"{args.output_prefix}_bins.tsv", index=False, sep='\t')
         gffWriter(results,args.output_prefix)
     else:
         for line in results.iterrows():
-            print(f"{line[1][0]}, {line[1][1]}, {line[1][4]}, {line[1][5]}")
+            print(f"{line[1]['Library']}, {line[1]['Sequence']}, {line[1]['Start']}, {line[1]['End']}")
     #plotBreakpoints(spectra, penalty=args.penalty, min_size=args.size, index=indexLength, dim=spectraDimensions, output=args.output_tsv if args.output_tsv else '')
     #
\ No newline at end of file
@@ -3,27 +3,76 @@
 import os
 import csv
 import logging
+import numpy as np
+import spectral
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger()
 
+# Rows read at a time from each input by collateSpectra
+CHUNK_ROWS = 100000
+
+# Exits unless every input has the same columns, in the same order, as the first one
+def check_columns(inputs):
+    columns = list(spectral.spectraHead(inputs[0]).columns)
+    for spectraInput in inputs[1:]:
+        if list(spectral.spectraHead(spectraInput).columns) != columns:
+            logging.error(f"'{spectraInput}' has different columns than '{inputs[0]}', only spectra of the same k-mers can be collated")
+            exit()
+
+# Binary store dtype holding the measurements of every input, from the footer of binary stores and by reading TSVs
+# CHUNK_ROWS rows at a time
+def collated_dtype(inputs):
+    dtypes = []
+    for spectraInput in inputs:
+        if spectral.isBinarySpectra(spectraInput):
+            dtypes.append(spectral.readSpectraMeta(spectraInput)["dtype"])
+        else:
+            dtypes += [spectral.spectraDtype(spectra) for spectra in spectral.iterSpectra(spectraInput, CHUNK_ROWS)]
+    return np.result_type(*dtypes) if dtypes else np.dtype("uint32")
+
+# Collates through spectra tables when any input or the output is a binary spectra store or an indexed BGZF TSV
+def collateSpectra(args, inputs):
+    first = spectral.spectraHead(inputs[0])
+    columns = [a for a in first.columns if a not in spectral.SPECTRA_DESCRIPTORS]
+    with spectral.openSpectraWriter(args.output, columns, dtype=collated_dtype(inputs), **first.attrs.get("spectra", {})) as spectraWriter:
+        for spectraInput in inputs:
+            for spectra in spectral.iterSpectra(spectraInput, CHUNK_ROWS):
+                spectraWriter.writeFrame(spectra)
+            logging.info(f"{spectraInput} collated")
+
 def execute(args):
     if args.verbose:
         logger.setLevel(logging.INFO)
 
+    inputs = []
+    for spectraInput in args.input_tsvs:
+        if not os.path.exists(spectraInput):
+            logging.error(f"Could not find input file '{spectraInput}', skipping this file")
+        else:
+            inputs.append(spectraInput)
+    if not inputs:
+        return
+
+    try:
+        check_columns(inputs)
+        if any(spectral.isBinarySpectra(a) or a.endswith(".gz") for a in inputs + [args.output]):
+            collateSpectra(args, inputs)
+            return
+    except ValueError as error:
+        logging.error(error)
+        exit()
+
     with open(args.output, 'w') as outputFile:
         headers = 0
         tsvWriter = csv.writer(outputFile, delimiter='\t')
-        for spectraInput in args.input_tsvs:
-            if not os.path.exists(spectraInput):
-                logging.error(f"Could not find input file '{spectraInput}', skipping this file")
-            else:
-                with open(spectraInput, 'r') as inputFile:
-                    tsvReader = csv.reader(inputFile, delimiter='\t')
-                    if not headers:
-                        headers = next(tsvReader)
-                        tsvWriter.writerow(headers)
-                    else:
-                        next(tsvReader)
-                    for spectraWindow in tsvReader:
-                        tsvWriter.writerow(spectraWindow)
-                logging.info(f"{spectraInput} collated")
+        for spectraInput in inputs:
+            with open(spectraInput, 'r') as inputFile:
+                tsvReader = csv.reader(inputFile, delimiter='\t')
+                if not headers:
+                    headers = next(tsvReader)
+                    tsvWriter.writerow(headers)
+                else:
+                    next(tsvReader)
+                for spectraWindow in tsvReader:
+                    tsvWriter.writerow(spectraWindow)
+            logging.info(f"{spectraInput} collated")
@@ -4,20 +4,21 @@
 
 import os
 import time
-from Bio import SeqIO, Seq
-import csv
 import logging
 import spectral
 import pandas as pd
 import itertools
+import contextlib
+import multiprocessing
+import numpy as np
 from collections import namedtuple, Counter
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger()
 
 WindowTask = namedtuple("WindowTask", ["seq", "queries", "start", "end", "headers"])
-def window_tasks(sequence_record, queries, width, spacing, headers, offset=0):
-    seq_str = str(sequence_record.seq).upper()
+def window_tasks(sequence, queries, width, spacing, headers, offset=0):
+    seq_str = str(sequence).upper()
     seq_len = len(seq_str)
 
     for i in range(0, seq_len, spacing):
@@ -26,6 +27,106 @@ def window_tasks(sequence_record, queries, width, spacing, headers, offset=0):
             continue
         yield WindowTask(window, queries, i+offset, min(i+width+offset, seq_len+offset), headers)
 
+# cache_key is set for every chunk when --cache is used, and cached tasks are read from the cache instead of counted
+ChunkTask = namedtuple("ChunkTask", ["name", "start", "end", "headers", "cache_key", "cached"], defaults=[None, False])
+
+# Counts windows of an encoded sequence (or sub-sequence) with the numpy engine, yielding (starts, ends, counts) blocks.
+# counts are dense up to spectral.DENSE_MAX_MER and sparse CSR matrices above it
+def numpy_blocks(codes, mer_size, width, spacing, overlap=True, offset=0):
+    counter = spectral.countKmerWindows if mer_size <= spectral.DENSE_MAX_MER else spectral.countKmerWindowsSparse
+    for starts, ends, counts in counter(codes, mer_size, width, spacing, overlap):
+        yield starts + offset + 1, ends + offset, counts
+
+# Counts windows of a sequence (or sub-sequence) with windowCount/windowCountNoOverlap as a single block
+def python_blocks(sequence, queries, width, spacing, callableProcess, offset=0):
+    rows = [callableProcess(task) for task in window_tasks(sequence, queries, width, spacing, [], offset=offset)]
+    if rows:
+        rows = np.array(rows, dtype=np.int64)
+        yield rows[:, 0], rows[:, 1], rows[:, 2:]
+
+# Sets up the sequence file and count options for count_chunk, once per worker process
+def init_worker(args, sequences):
+    global COUNT_ARGS
+    global COUNT_SEQUENCES
+    COUNT_ARGS = args
+    COUNT_SEQUENCES = sequences
+
+# Counts every window of one chunk of a sequence
+def count_chunk(task):
+    if task.cached:
+        return None
+    args = COUNT_ARGS
+    if args.engine == 'numpy' or args.mer_size > spectral.DENSE_MAX_MER:
+        codes = COUNT_SEQUENCES.encode(task.name, task.start, task.end)
+        blocks = numpy_blocks(codes, args.mer_size, args.width, args.spacing, args.overlap, offset=task.start)
+    else:
+        sub_seq = COUNT_SEQUENCES.fetch(task.name, task.start, task.end).tobytes().decode('ascii', errors='replace')
+        callableProcess = spectral.windowCount if args.overlap else spectral.windowCountNoOverlap
+        blocks = python_blocks(sub_seq, spectral.setMers(args.mer_size), args.width, args.spacing, callableProcess, offset=task.start)
+    if args.complement:
+        return [(starts, ends, spectral.foldCanonical(counts, args.mer_size)) for starts, ends, counts in blocks]
+    return list(blocks)
+
+# Rows of the long (Library, Sequence, Start, End, Mer, Count) layout used for sparse counts, one per non-zero k-mer
+def sparse_rows(headers, starts, ends, counts, mer_size):
+    mers = spectral.decodeKmers(counts.indices, mer_size).tolist()
+    data = counts.data.tolist()
+    for row, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        for position in range(counts.indptr[row], counts.indptr[row + 1]):
+            yield headers + [start, end, mers[position], data[position]]
+
+# Writes the (starts, ends, counts) blocks of one sequence, in the long layout for sparse counts
+def write_blocks(spectra_writer, headers, blocks, mer_size):
+    for starts, ends, counts in blocks:
+        if mer_size > spectral.DENSE_MAX_MER:
+            spectra_writer.writerows(sparse_rows(headers, starts, ends, counts, mer_size))
+        else:
+            spectra_writer.writeBlock(headers, starts, ends, counts)
+
+# Splits one sequence into chunk_size tasks. Each chunk is cached under the sequence cache_key and its chunk index
+def sequence_chunks(sequence_name, sequence_length, headers, chunk_size, cache_key=None, cache=None):
+    for chunkIndex, sequenceIndex in enumerate(range(0, sequence_length, chunk_size)):
+        chunkKey = f"{cache_key}.{chunkIndex}" if cache_key is not None else None
+        cached = cache is not None and cache.touch(chunkKey)
+        yield ChunkTask(sequence_name, sequenceIndex, min(sequenceIndex + chunk_size, sequence_length), headers, chunkKey, cached)
+
+# Cache key of a sequence's content and every option that changes its counted windows
+def sequence_cache_key(sequences, sequence_name, args):
+    sequenceLength = sequences.length(sequence_name)
+    pieces = (sequences.fetch(sequence_name, i, i + args.chunk_size) for i in range(0, sequenceLength, args.chunk_size))
+    parameters = [args.mer_size, args.width, args.spacing, args.overlap, args.complement, args.chunk_size]
+    return spectral.BlockCache.key(parameters, pieces)
+
+# Splits sequences into chunk_size tasks, in file order. Chunks found in cache become cached tasks
+def chunk_tasks(sequences, args, cache=None):
+    for sequence_name in sequences.keys():
+        headers = sequence_name.split("_") if args.libraries else [os.path.basename(args.input_sequence),
+                                                                   sequence_name]
+        sequenceLength = sequences.length(sequence_name)
+        if sequenceLength < args.minimum_size:
+            continue
+        cache_key = sequence_cache_key(sequences, sequence_name, args) if cache is not None else None
+        if sequenceLength >= args.chunk_size:
+            logging.info(f"Sequence {sequence_name} is large. Breaking into smaller segments")
+        yield from sequence_chunks(sequence_name, sequenceLength, headers, args.chunk_size, cache_key, cache)
+
+# Sums the blocks of one chunk into each pyramid level (2x, 4x, ...), returning the new blocks of every level. The odd
+# last window of a level is carried over to the next chunk of the sequence in carries, and kept alone when final
+def pyramid_blocks(carries, blocks, final=False):
+    levels = []
+    for level, carry in enumerate(carries):
+        pending = ([carry] if carry is not None else []) + blocks
+        carries[level], blocks = None, []
+        if pending:
+            starts, ends, counts = spectral.concatenateBlocks(pending)
+            paired = len(starts) if final else len(starts) - len(starts) % 2
+            if paired < len(starts):
+                carries[level] = (starts[paired:], ends[paired:], counts[paired:])
+            if paired:
+                blocks = [spectral.aggregateWindows(starts[:paired], ends[:paired], counts[:paired], factor=2)]
+        levels.append(blocks)
+    return levels
+
 
 def execute(args):
     if args.verbose:
@@ -36,8 +137,8 @@ def execute(args):
         logging.error(f"Couldn't find input file '{args.input_sequence}'")
         exit()
 
-    sequences = SeqIO.index(args.input_sequence, args.sequence_format)
     try:
+        sequences = spectral.openSequences(args.input_sequence, args.sequence_format)
         if len(sequences.keys()) == 0:
             logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}' or has incorrectly formatted sequences")
             exit()
@@ -45,49 +146,65 @@ def execute(args):
         logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}'")
         exit()
 
-    queries_all=spectral.setMers(args.mer_size)
-    rep_map = {q: spectral.canonical(q) for q in queries_all}
-    #queries = ["".join(a) for a in list(itertools.product(bases, repeat=args.mer_size))]
-    if args.complement:
-        queries = spectral.mapCanonicalMers(queries_all)
+    # above DENSE_MAX_MER there are too many k-mers for one column each, so counts are written in a long layout
+    sparseCounts = args.mer_size > spectral.DENSE_MAX_MER
+    if args.mer_size < 1 or args.mer_size > spectral.SPARSE_MAX_MER:
+        logging.error(f"Mer size must be between 1 and {spectral.SPARSE_MAX_MER}")
+        exit()
+    if sparseCounts:
+        queries = []
+    elif args.complement:
+        queries = spectral.decodeKmers(spectral.canonicalPairs(args.mer_size)[0], args.mer_size).tolist()
     else:
-        queries = {queries_all[a]: [a] for a in range(len(queries_all))}
+        queries = spectral.setMers(args.mer_size)
 
-    with open(args.output, 'w', newline='') as fileOutput:
-        tsvHeaders = ["Library", "Sequence", "Start", "End"] + list(queries.keys())
-        tsvWriter = csv.writer(fileOutput, delimiter='\t')
-        tsvWriter.writerow(tsvHeaders)
-        callableProcess = spectral.windowCount if args.overlap else spectral.windowCountNoOverlap
+    if sparseCounts and args.output.endswith(spectral.SPECTRA_EXTENSION):
+        logging.error(f"Mer sizes above {spectral.DENSE_MAX_MER} are written in a long layout and can only be output as tsv")
+        exit()
+
+    if args.pyramid and args.width != args.spacing:
+        logging.error("Pyramid levels are built from adjacent windows, so width and spacing must be the same")
+        exit()
+
+    cache = spectral.BlockCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None
+
+    # chunks are counted in worker processes but written in input order, with at most 2 chunks per worker in flight
+    pool = None
+    if args.threads > 1:
+        pool = multiprocessing.Pool(processes=args.threads, initializer=init_worker, initargs=(args, sequences))
+    init_worker(args, sequences)
+
+    # pyramid levels 2x, 4x, 8x, ... are summed from the base windows of each sequence and written next to the output.
+    # Levels of earlier runs are removed, and levels are opened first so the base table is closed before them
+    spectral.removePyramidLevels(args.output, args.pyramid)
+    with contextlib.ExitStack() as writers:
+        spectraWriters = []
+        for factor in reversed([2 ** level for level in range(args.pyramid + 1)]):
+            spectraWriters.insert(0, writers.enter_context(spectral.openSpectraWriter(
+                spectral.pyramidPath(args.output, factor) if factor > 1 else args.output,
+                ["Mer", "Count"] if sparseCounts else queries, mer_size=args.mer_size, canonical=args.complement,
+                width=args.width * factor, spacing=args.spacing * factor, overlap=args.overlap)))
+        # only the blocks of one chunk (and one carried window per pyramid level) are held at a time
+        carries = [None] * args.pyramid
+        for task, blocks in spectral.orderedImap(pool, count_chunk, chunk_tasks(sequences, args, cache), args.threads * 2):
+            if task.cached:
+                logging.info(f"Sequence {task.name} chunk at {task.start} found in cache")
+                blocks = cache.load(task.cache_key)
+                # evicted since the task was queued, so count it here
+                if blocks is None:
+                    blocks = count_chunk(task._replace(cached=False))
+                    cache.store(task.cache_key, blocks)
+            elif cache is not None:
+                cache.store(task.cache_key, blocks)
+            write_blocks(spectraWriters[0], task.headers, blocks, args.mer_size)
+            sequenceEnd = task.end == sequences.length(task.name)
+            for spectraWriter, levelBlocks in zip(spectraWriters[1:], pyramid_blocks(carries, blocks, sequenceEnd)):
+                write_blocks(spectraWriter, task.headers, levelBlocks, args.mer_size)
+            if sequenceEnd:
+                logging.info(f"Sequence {task.name} windows written to output file")
 
-        for sequence_name, seq_record in sequences.items():
-            headers = sequence_name.split("_") if args.libraries else [os.path.basename(args.input_sequence),
-                                                                       sequence_name]
-            sequenceLength = len(seq_record)
-            if sequenceLength >= args.minimum_size and sequenceLength >= args.chunk_size:
-                logging.info(f"Sequence {sequence_name} is large. Breaking into smaller segments")
-                indices = range(0, sequenceLength, args.chunk_size)
-                for sequenceIndex in indices:
-                    sub_seq = seq_record[sequenceIndex:sequenceIndex + args.chunk_size]
-                    for task in window_tasks(sub_seq, queries_all, args.width, args.spacing, headers, offset=sequenceIndex):
-                        row = callableProcess(task)
-                        if args.complement:
-                            tsvWriter.writerow(spectral.collapseRC(row, queries))
-                        else:
-                            tsvWriter.writerow(row)
-                logging.info(f"Sequence {sequence_name} windows written to output file")
-            elif sequenceLength >= args.minimum_size:
-                for task in window_tasks(seq_record, queries_all, args.width, args.spacing, headers):
-                    row = callableProcess(task)
-                    if args.complement:
-                        tsvWriter.writerow(spectral.collapseRC(row, queries))
-                    else:
-                        tsvWriter.writerow(row)
-                logging.info(f"Sequence {sequence_name} windows written to output file")
-
-    #if args.complement:
-    #    logging.info("Simplifying forward and r-c counts")
-    #    spectra = pd.read_csv(args.output, delimiter='\t')
-    #    spectra = spectral.simplify(spectra, dim=len(queries))
-    #    spectra.to_csv(args.output, sep='\t', index=False)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     logging.info(f'Execution time in seconds: {time.time() - startTime}')
@@ -43,18 +43,17 @@ def execute(args):
         logging.error(f"Could not find input file '{args.input_tsv}'")
         exit()
 
-    spectraPanda = pd.read_csv(args.input_tsv, sep='\t')
+    # indexed (.gz) and binary spectra are read only over the requested sequences and zoom
+    sequences = args.sequence.split(',') if args.sequence else None
+    zoom = [int(a) for a in args.zoom_width.split(',')] if args.zoom_width else [None, None]
+    try:
+        spectraPanda = spectral.readSpectraResolution(args.input_tsv, args.resolution, sequences, zoom[0], zoom[1])
+    except ValueError as error:
+        logging.error(error)
+        exit()
     plotColors = [colorizeMer(a) for a in spectraPanda.columns if a[0] in ['A', 'C', 'G', 'T']]
 
     validation = spectral.validate(spectraPanda)
-    if args.sequence:
-        sequences = args.sequence.split(',')
-        spectraPanda = spectraPanda.loc[spectraPanda['Sequence'].isin(sequences)]
-
-    if args.zoom_width:
-        zoom = args.zoom_width.split(',')
-        spectraPanda = spectraPanda.loc[spectraPanda['Start'] >= int(zoom[0])]
-        spectraPanda = spectraPanda.loc[spectraPanda['End'] <= int(zoom[1])]
 
     spectraGroups = spectraPanda.groupby(['Sequence'])
     for group in spectraGroups:
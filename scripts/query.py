@@ -4,16 +4,64 @@
 
 import os
 import time
-from Bio import SeqIO
-import csv
 import logging
+import multiprocessing
+import numpy as np
 import spectral
-import pandas as pd
+from collections import namedtuple
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger()
 
+# A chunk holds the windows starting between start and end of a sequence
+ChunkTask = namedtuple("ChunkTask", ["name", "start", "end", "headers"])
+
+# Sets up the sequence file, queries and query options for count_chunk, once per worker process.
+# folding maps the counts of every query onto the output columns, when they differ
+def init_worker(args, sequences, queries, folding=None):
+    global QUERY_ARGS
+    global QUERY_SEQUENCES
+    global QUERY_QUERIES
+    global QUERY_FOLDING
+    QUERY_ARGS = args
+    QUERY_SEQUENCES = sequences
+    QUERY_QUERIES = queries
+    QUERY_FOLDING = folding
+
+# Counts every window starting in one chunk of a sequence, reading bases up to the end of its last window
+def count_chunk(task):
+    args = QUERY_ARGS
+    lastStart = task.end - 1 - (task.end - 1 - task.start) % args.spacing
+    sub_seq = QUERY_SEQUENCES.fetch(task.name, task.start, min(lastStart + args.width, QUERY_SEQUENCES.length(task.name)))
+    blocks = []
+    for starts, ends, counts in spectral.countQueryWindows(sub_seq, QUERY_QUERIES, args.width, args.spacing, args.overlap):
+        keep = starts < task.end - task.start
+        counts = counts[keep] if QUERY_FOLDING is None else counts[keep] @ QUERY_FOLDING
+        blocks.append((starts[keep] + task.start, ends[keep] + task.start, counts))
+    return blocks
+
+# Output columns of query -c and the folding of the counted queries onto them. Each query is counted with its reverse
+# complement and both are summed into the first of the pair in the given order; palindromes are counted once
+def complement_folding(queries):
+    columns = []
+    for query in queries:
+        if query not in columns and spectral.rc(query) not in columns:
+            columns.append(query)
+    partners = [column for column, query in enumerate(columns) if spectral.rc(query) != query]
+    folding = np.zeros((len(columns) + len(partners), len(columns)), dtype=np.uint32)
+    folding[np.arange(len(folding)), list(range(len(columns))) + partners] = 1
+    return columns, columns + [spectral.rc(columns[column]) for column in partners], folding
+
+# Splits sequences into tasks of chunk_size window starts, in file order
+def chunk_tasks(sequences, args, chunk_size):
+    for sequence_name in sequences.keys():
+        headers = sequence_name.split("_") if args.libraries else [os.path.basename(args.input_sequence), sequence_name]
+        sequenceLength = sequences.length(sequence_name)
+        for sequenceIndex in range(0, sequenceLength, chunk_size):
+            yield ChunkTask(sequence_name, sequenceIndex, min(sequenceIndex + chunk_size, sequenceLength), headers)
+
 def execute(args):
-    maxSize = 9000000 if 9000000 % args.spacing != 0 else (9000000 // args.spacing) * args.spacing
+    # chunks start on a window start; memory-conservation mode reads a single window at a time
+    chunkSize = args.spacing if args.memory else max(args.chunk_size // args.spacing, 1) * args.spacing
 
     if args.verbose:
         logger.setLevel(logging.INFO)
@@ -27,54 +75,38 @@ def execute(args):
         queries = [a.upper() for a in args.query.split(',')]
     else:
         queries = [args.query.upper()]
-    sequences = {}
-    if args.memory:
-        try:
-            sequences = SeqIO.index(args.input_sequence, args.sequence_format)
-            if len(sequences.keys()) == 0:
-                logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}' or has incorrectly formatted sequences")
-                exit()
-        except ValueError:
-            logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}'")
-            exit()
-    else:
-        try:
-            sequences = SeqIO.to_dict(SeqIO.parse(args.input_sequence, args.sequence_format))
-            if len(sequences.keys()) == 0:
-                logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}' or has incorrectly formatted sequences")
-                exit()
-        except ValueError:
-            logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}'")
+    try:
+        sequences = spectral.openSequences(args.input_sequence, args.sequence_format)
+        if len(sequences.keys()) == 0:
+            logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}' or has incorrectly formatted sequences")
             exit()
+    except ValueError:
+        logging.error(f"Sequence file '{args.input_sequence}' could not be loaded in format '{args.sequence_format}'")
+        exit()
 
+    # with -c, forward and reverse-complement counts are folded in each chunk before its windows are written
+    columns, folding = queries, None
     if args.complement:
-        newQueries = []
-        for query in queries:
-            queryRC = spectral.rc(query)
-            if query not in newQueries or queryRC not in newQueries:
-                newQueries.append(query)
-                newQueries.append(queryRC)
-        queries = list(set(newQueries))
-
-    with open(args.output, 'w', newline='') as fileOutput:
-        tsvWriter = csv.writer(fileOutput, delimiter='\t')
-        tsvWriter.writerow(["Library", "Sequence", "Start", "End"] + queries)
-
-        callableProcess = spectral.windowCount if args.overlap else spectral.windowCountNoOverlap
-
-        for sequence in sequences:
-            headers = sequence.split("_") if args.libraries else [os.path.basename(args.input_sequence), sequence]
-            toProcess = [[sequences[sequence][i:i+args.width].seq.upper(), queries, i, i + args.width, headers] for i in range(0, len(sequences[sequence])+args.spacing, args.spacing) if len(sequences[sequence][i:i+args.width].seq) > 0]
-            rows = map(callableProcess, toProcess)
-            tsvWriter.writerows(rows)
-            logging.info(f"Sequence {sequence} windows written to output file")
+        columns, queries, folding = complement_folding(queries)
 
-    if args.complement:
-        logging.info("Simplifying forward and r-c counts")
-        spectra = pd.read_csv(args.output, delimiter='\t')
-        spectra = spectral.simplify(spectra, dim=len(queries))
-        spectra.to_csv(args.output, sep='\t', index=False)
+    # chunks are counted in worker processes but written in input order, with at most 2 chunks per worker in flight.
+    # Every query is counted in a single pass over each chunk by the multi-pattern engine
+    pool = None
+    if args.threads > 1:
+        pool = multiprocessing.Pool(processes=args.threads, initializer=init_worker, initargs=(args, sequences, queries, folding))
+    init_worker(args, sequences, queries, folding)
+
+    with spectral.openSpectraWriter(args.output, columns, canonical=args.complement, width=args.width,
+                                    spacing=args.spacing, overlap=args.overlap) as spectraWriter:
+        for task, blocks in spectral.orderedImap(pool, count_chunk, chunk_tasks(sequences, args, chunkSize), args.threads * 2):
+            for starts, ends, counts in blocks:
+                spectraWriter.writeBlock(task.headers, starts + 1, ends, counts)
+            if task.end == sequences.length(task.name):
+                logging.info(f"Sequence {task.name} windows written to output file")
 
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     logging.info(f'Execution time in seconds: {time.time() - startTime}')
 
@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 import os
 import numpy as np
-import scipy.stats as sp
-import pandas as pd
 import logging
 import spectral
 logging.basicConfig(level=logging.ERROR)
@@ -15,38 +13,93 @@ def groupByRows(group, rows, dim=64):
         subGroup[1][subGroup[1].keys()[4:dim+4]].agg('sum')
     return subGroups
 
-def normalize(row, frequencies, chiValue=1, dim=64):
-    if row[4:dim+4].sum() != 0:
-        localFrequencies = np.array(np.divide(row[4:dim+4], row['End'] - row['Start'] - 1))
-        if np.sum(localFrequencies) < 1:
-            localFrequencies = np.divide(localFrequencies, np.sum(localFrequencies))
-        chiResult = sp.chisquare(localFrequencies, f_exp=frequencies)
-        return 1 if chiResult[0] > chiValue else 0
-    else:
-        return 1
-
-def filterNormal(spectra, frequencies, file, chiValue=1, dim=64):
-    spectra = spectra.assign(Normal=0)
-    frequencies = np.array(np.divide(list(frequencies.values()), np.sum(list(frequencies.values()))))
-    for row in spectra.iterrows():
-        spectra.iloc[row[0], 68] = normalize(row[1], frequencies, chiValue)
-    resultsOut = spectra.copy()
-
-    resultsOut.iloc[spectra['Normal'] == 1, 4:dim+4] = 0
-    del resultsOut['Normal']
-    resultsOut.to_csv(f"normal_{file}", sep='\t', index=False)
-    spectra.iloc[spectra['Normal'] == 0, 4:dim+4] = 0
-    del spectra['Normal']
-    spectra.to_csv(f"outlier_{file}", sep='\t', index=False)
-
-def reduceFrequencies(spectra, frequencies):
-    width = spectra['End'][0] - spectra['Start'][0] - 1
-    for mer in frequencies:
-        count = width * frequencies[mer]
-        spectra[mer] = spectra[mer].apply(lambda x: round((x - count)/count))
+# Flags windows whose k-mer frequencies deviate from the global frequencies by a chi-square statistic above chiValue,
+# for all windows at once. Windows without any counted k-mer are always flagged
+def normalize(spectra, frequencies, chiValue=1):
+    mers = list(frequencies)
+    expected = np.array([frequencies[a] for a in mers], dtype=float)
+    expected = expected / expected.sum()
+    counts = spectra[mers].to_numpy(dtype=float)
+    positions = (spectra['End'] - spectra['Start'] - (len(mers[0]) - 2)).to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        localFrequencies = counts / positions[:, None]
+        totals = localFrequencies.sum(axis=1)
+        # windows whose frequencies sum below 1 (any k-mer skipped over N) are rescaled to sum to 1
+        localFrequencies = np.where((totals < 1)[:, None], localFrequencies / totals[:, None], localFrequencies)
+        chiValues = ((localFrequencies - expected) ** 2 / expected).sum(axis=1)
+    return (chiValues > chiValue) | (counts.sum(axis=1) == 0)
+
+# Splits spectra into (normal, outlier) copies, each with the other windows' counts set to 0
+def filterNormal(spectra, frequencies, chiValue=1):
+    mers = list(frequencies)
+    outliers = normalize(spectra, frequencies, chiValue)[:, None]
+    counts = spectra[mers].to_numpy()
+    normal, outlier = spectra.copy(), spectra.copy()
+    normal[mers] = np.where(outliers, 0, counts)
+    outlier[mers] = np.where(outliers, counts, 0)
+    return normal, outlier
+
+# Applies -n, -c and -y to spectra, either a whole table or one chunk of it
+def transform_spectra(spectra, frequencies, args, positions=None):
+    descriptors, mers = spectral.validate(spectra)
+    if args.weighted_normalization:
+        spectra = spectral.reduceFrequencies(spectra, frequencies, positions=positions)
+
+    if args.convert and args.frequencies:
+        spectra = spectral.frequencyToCount(spectra, dim=len(mers))
+    elif args.convert:
+        spectra = spectral.countToFrequency(spectra, dim=len(mers))
 
+    if args.simplify:
+        spectra = spectral.simplify(spectra, dim=len(mers))
     return spectra
 
+# Appends a transformed chunk to path, opening its writer with the chunk's columns on first use
+def write_chunk(writers, path, spectra):
+    if path not in writers:
+        columns = [a for a in spectra.columns if a not in spectral.SPECTRA_DESCRIPTORS]
+        # later chunks may not fit the first chunk's narrowest type, e.g. negative -n deviations
+        dtype = "int64" if np.issubdtype(spectra[columns].to_numpy().dtype, np.integer) else "float64"
+        writers[path] = spectral.openSpectraWriter(path, columns, dtype=dtype, lineterminator='\n', **spectra.attrs.get("spectra", {}))
+    writers[path].writeFrame(spectra)
+
+# Streams the input chunk_rows rows at a time: a first pass accumulates the global frequencies and a second pass
+# transforms and appends each chunk, so memory is bounded by the chunk size instead of the input size
+def stream(args):
+    if args.resize_window:
+        logging.error("Windows cannot be resized while streaming, resize without -k or use count --pyramid")
+        exit()
+
+    try:
+        first = next(spectral.iterSpectra(args.input_tsv, 1))
+    except ValueError as error:
+        logging.error(error)
+        exit()
+    descriptors, mers = spectral.validate(first)
+    frequencies = {}
+    if args.weighted_filter or args.weighted_normalization or args.verbose:
+        frequencies = spectral.getChunkedGlobalFrequencies(spectral.iterSpectra(args.input_tsv, args.chunk_rows), dim=len(mers))
+
+    if args.print:
+        logging.info('Reported frequencies (JSON/pydict):')
+        logging.info(frequencies)
+
+    # -n compares every window with the k-mer positions of the first window of the whole input
+    positions = first['End'].iloc[0] - first['Start'].iloc[0] - (len(mers[0]) - 2)
+    writers = {}
+    try:
+        for spectra in spectral.iterSpectra(args.input_tsv, args.chunk_rows):
+            if args.weighted_filter:
+                normal, outlier = filterNormal(spectra, frequencies)
+                write_chunk(writers, f"normal_{args.input_tsv}", normal)
+                write_chunk(writers, f"outlier_{args.input_tsv}", outlier)
+            spectra = transform_spectra(spectra, frequencies, args, positions)
+            if args.output:
+                write_chunk(writers, args.output, spectra)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
 def execute(args):
     if args.verbose:
         logger.setLevel(logging.INFO)
@@ -55,43 +108,30 @@ def execute(args):
         logging.error(f"Could not find input file '{args.input_tsv}'")
         exit()
 
-    spectra = pd.read_csv(args.input_tsv, delimiter='\t')
-    if args.resize_window:
-        targetFactor = int(args.resize_window)
-        if targetFactor > 1:
-            spectraGroups = spectra.groupby(['Library', 'Sequence'])
-            spectra = pd.DataFrame()
-            for group in spectraGroups:
-                for index in range(0, len(group[1]), targetFactor):
-                    subset = group[1].iloc[index:index+targetFactor]
-                    newSubset = subset.sum().to_frame().transpose()
-                    newSubset[0, 'Library'] = group[0][0]
-                    newSubset[0, 'Sequence'] = group[0][1]
-                    newSubset[0, 'Start'] = subset['Start'].min()
-                    newSubset[0, 'End'] = subset['End'].max()
-                    spectra = pd.concat([spectra, newSubset], ignore_index=True)
-        spectra.reindex()
+    if args.chunk_rows:
+        stream(args)
+        return
+
+    try:
+        spectra = spectral.readSpectraLevel(args.input_tsv, args.resize_window or 1)
+    except ValueError as error:
+        logging.error(error)
+        exit()
+    descriptors, mers = spectral.validate(spectra)
     frequencies = {}
     if args.weighted_filter or args.weighted_normalization or args.verbose:
-        frequencies = spectral.getGlobalFrequencies(spectra)
+        frequencies = spectral.getGlobalFrequencies(spectra, dim=len(mers))
 
     if args.print:
         logging.info('Reported frequencies (JSON/pydict):')
         logging.info(frequencies)
 
     if args.weighted_filter:
-        filterNormal(spectra, frequencies, args.input_tsv)
+        normal, outlier = filterNormal(spectra, frequencies)
+        spectral.writeSpectra(normal, f"normal_{args.input_tsv}")
+        spectral.writeSpectra(outlier, f"outlier_{args.input_tsv}")
 
-    if args.weighted_normalization:
-        spectra = reduceFrequencies(spectra, frequencies)
-
-    if args.convert and args.frequencies:
-        spectra = spectral.frequencyToCount(spectra)
-    elif args.convert:
-        spectra = spectral.countToFrequency(spectra)
-
-    if args.simplify:
-        spectra = spectral.simplify(spectra)
+    spectra = transform_spectra(spectra, frequencies, args)
 
     if args.output:
-        spectra.to_csv(args.output, sep='\t', index=False)
\ No newline at end of file
+        spectral.writeSpectra(spectra, args.output)
\ No newline at end of file
@@ -69,6 +69,10 @@ def stream_compute_reductions(raw_file, asm_file, out_file, chunk_size=5000000,
             out.write(f"{k}\t{rc}\t{ac}\t{red:.6f}\t{rank}\n")
             rank += 1
 
+    # row count sidecar, so mass-query.py can size its percentile bins without reading the table twice
+    with open(f"{out_file}.rows", "w") as rows:
+        rows.write(f"{rank - 1}\n")
+
     # cleanup
     for f in tmp_files:
         os.remove(f)
@@ -96,6 +96,13 @@ if(is.null(opt$input_filename)){
   values = readr::read_tsv(opt$input_filename, show_col_types = FALSE)
 }
 
+# wide layout (mass-query.py --layout wide) has a column per bin, pivot it to the long Bin/Count layout
+if(!("Bin" %in% colnames(values))){
+  values = values %>%
+    select(-any_of("Library")) %>%
+    pivot_longer(starts_with("pct"), names_to="Bin", values_to="Count")
+}
+
 if(!is.null(opt$sequences)){
   if(opt$regex){
     values = values %>% filter(grepl(opt$sequences, Sequence))
@@ -1,55 +1,190 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
 import time
-from Bio import SeqIO
 import csv
 import logging
-from collections import Counter, defaultdict
+import itertools
 import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import spectral
 
 # Fast reverse-complement using translation table
 RC_TRANS = str.maketrans("ACGTacgt", "TGCAtgca")
 def rc(sequence):
     return sequence.translate(RC_TRANS)[::-1]
 
-# Sliding window utility
-def window_tasks(sequence_record, width, spacing, sequence_name, offset=0):
-    seq_len = len(sequence_record)
-    for i in range(0, seq_len, spacing):
-        window = sequence_record[i:i+width]
-        if not window:
-            continue
-        start = i + offset
-        # The original script uses min(i+width+offset, seq_len+offset) for end
-        # and start + len(windowSeq) for end in windowCount.
-        # We'll use the actual window length to be precise.
-        window_str = str(window)
-        end = start + len(window_str)
-        yield (window_str, sequence_name, start, end)
-
-def process_window(task):
-    windowSeq, sequence_name, start, end = task
-    local_counts = Counter()
-    for i in range(len(windowSeq) - GLOBAL_MER_SIZE + 1):
-        kmer = windowSeq[i:i + GLOBAL_MER_SIZE]
-        if kmer in GLOBAL_KMER_MAP:
-            for bin_name in GLOBAL_KMER_MAP[kmer]:
-                local_counts[bin_name] += 1
-
-    rows = []
-    # To maintain compatibility with multi-pass output, we return rows for all bins
-    for bin_name in GLOBAL_BINS:
-        rows.append([sequence_name, bin_name, start + 1, end, local_counts.get(bin_name, 0)])
-    return rows
-
-def init_worker(kmer_map, mer_size, bins):
-    global GLOBAL_KMER_MAP
+# Bases of a chunk covered by the windows of one worker task
+RANGE_BASES = 1 << 20
+
+# Sliding window utility: splits the windows of a chunk into (offset, length, windows) tasks of about RANGE_BASES bases,
+# where windows start every spacing from offset and end at most at offset + length
+def window_ranges(chunk_length, width, spacing):
+    starts, ends = spectral.windowBounds(chunk_length, width, spacing)
+    batch = max(1, RANGE_BASES // spacing)
+    for first in range(0, len(starts), batch):
+        last = min(first + batch, len(starts)) - 1
+        yield (int(starts[first]), int(ends[last] - starts[first]), last - first + 1)
+
+# Window starts and ends of an (offset, length, windows) range
+def range_windows(offset, length, windows, width, spacing):
+    starts = offset + np.arange(windows, dtype=np.int64) * spacing
+    return starts, np.minimum(starts + width, offset + length)
+
+# Largest kmer that packs into the uint64 lookup table
+MAX_MER_SIZE = 32
+
+# 2-bit indices (as uint64) of the kmers made of mer_size ACGT bases; any other kmer can never match a window
+def encode_kmers(kmers, mer_size):
+    codes = spectral.encodeSequence("".join(kmer for kmer in kmers if len(kmer) == mer_size)).reshape(-1, mer_size)
+    indices = np.zeros(len(codes), dtype=np.uint64)
+    for offset in range(mer_size):
+        indices = (indices << np.uint64(2)) | (codes[:, offset] & 3).astype(np.uint64)
+    return indices[(codes < spectral.INVALID_BASE).all(axis=1)]
+
+# Sorts the kmer indices of every bin into one lookup table of (kmer, bin number) entries. A kmer listed in several
+# bins, or twice in one bin, keeps an entry per listing and is counted once per listing
+def build_kmer_table(indices, bin_ids):
+    indices, bin_ids = np.concatenate(indices), np.concatenate(bin_ids)
+    order = np.argsort(indices, kind="stable")
+    return indices[order], bin_ids[order]
+
+# Table entries matched by kmer indices, as (position in indices, entry) pairs
+def table_matches(indices, kmers):
+    low = np.searchsorted(kmers, indices, side="left")
+    matches = np.searchsorted(kmers, indices, side="right") - low
+    owners = np.repeat(np.arange(len(indices)), matches)
+    entries = np.repeat(low, matches) + np.arange(matches.sum()) - np.repeat(np.cumsum(matches) - matches, matches)
+    return owners, entries
+
+# Copies arrays into shared memory blocks, returning the blocks and the (name, dtype, length) of each for share_attach
+def share_arrays(*arrays):
+    blocks, descriptors = [], []
+    for array in arrays:
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(len(array), dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        descriptors.append((block.name, array.dtype.str, len(array)))
+    return blocks, descriptors
+
+# Read-only views of arrays shared with share_arrays, with the blocks that must stay open while they are used
+def share_attach(descriptors):
+    blocks = [shared_memory.SharedMemory(name=name) for name, dtype, length in descriptors]
+    arrays = [np.ndarray(length, dtype=dtype, buffer=block.buf) for block, (name, dtype, length) in zip(blocks, descriptors)]
+    for array in arrays:
+        array.flags.writeable = False
+    return blocks, arrays
+
+# Number of kmers in a ranked query table, from the row-count sidecar kmerRank.py writes next to it when it is at least
+# as new as the table, otherwise by counting lines
+def table_rows(path):
+    sidecar = f"{path}.rows"
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        with open(sidecar) as f:
+            return int(f.readline())
+    with open(path) as f:
+        f.readline() # skip header
+        return sum(1 for _ in f)
+
+# Loads the kmers of every (start_idx, end_idx) row range of a ranked query table in one sequential read, returning
+# their indices and bin numbers (the position of their range). Ranges must be sorted and not overlap
+def load_bins(path, ranges, mer_size, complement=False):
+    kmer_indices, kmer_bins = [], []
+    with open(path) as f:
+        f.readline() # skip header
+        idx = 0
+        for bin_id, (start_idx, end_idx) in enumerate(ranges):
+            for line in itertools.islice(f, start_idx - idx):
+                pass
+            kmers = []
+            for line in itertools.islice(f, end_idx - start_idx):
+                kmer = line.split("\t", 1)[0].strip().upper()
+                kmers.append(kmer)
+                if complement:
+                    kmers.append(rc(kmer))
+            idx = end_idx
+            indices = encode_kmers(kmers, mer_size)
+            kmer_indices.append(indices)
+            kmer_bins.append(np.full(len(indices), bin_id, dtype=np.uint8))
+    return kmer_indices, kmer_bins
+
+# Counts every bin in the windows of one (offset, length, windows) range of the shared chunk, as a windows x bins array
+def process_range(task):
+    offset, length, windows = task
+    indices, valid = spectral.kmerIndices(spectral.encodeSequence(GLOBAL_CHUNK[offset:offset + length]), GLOBAL_MER_SIZE)
+    positions = np.flatnonzero(valid)
+    owners, entries = table_matches(indices[positions].astype(np.uint64), GLOBAL_KMERS)
+    # a match counts in every window that starts at or before it and ends at or after its end
+    keys = np.sort(GLOBAL_KMER_BINS[entries].astype(np.int64) * (length + 1) + positions[owners])
+    starts, ends = range_windows(0, length, windows, GLOBAL_WIDTH, GLOBAL_SPACING)
+    binKeys = np.arange(len(GLOBAL_BINS), dtype=np.int64) * (length + 1)
+    low = np.searchsorted(keys, binKeys + starts[:, None])
+    high = np.searchsorted(keys, binKeys + np.maximum(ends - GLOBAL_MER_SIZE + 1, starts)[:, None])
+    return (high - low).astype(np.uint32)
+
+# Attaches the shared kmer table and sequence chunk, once per worker process
+def init_worker(table, chunk, mer_size, bins, width, spacing):
+    global GLOBAL_TABLE
+    global GLOBAL_KMERS
+    global GLOBAL_KMER_BINS
+    global GLOBAL_CHUNK
     global GLOBAL_MER_SIZE
     global GLOBAL_BINS
-    GLOBAL_KMER_MAP = kmer_map
+    global GLOBAL_WIDTH
+    global GLOBAL_SPACING
+    GLOBAL_TABLE, (GLOBAL_KMERS, GLOBAL_KMER_BINS, GLOBAL_CHUNK) = share_attach(table + chunk)
     GLOBAL_MER_SIZE = mer_size
     GLOBAL_BINS = bins
+    GLOBAL_WIDTH = width
+    GLOBAL_SPACING = spacing
+
+# Counts every bin in every window of the input sequences, yielding (sequence name, starts, ends, counts) blocks.
+# Each chunk of sequence is copied into the shared chunk_block that the workers of pool count from
+def range_counts(args, pool, chunk_block):
+    logger = logging.getLogger()
+    chunk_view = np.ndarray(args.chunk_size, dtype=np.uint8, buffer=chunk_block.buf)
+
+    # Scan genome once
+    sequences = spectral.openSequences(args.input, args.format)
+    for sequence_name in sequences.keys():
+        sequenceLength = sequences.length(sequence_name)
+        if sequenceLength < args.minimum_size:
+            continue
+
+        logger.info(f"Processing sequence {sequence_name} ({sequenceLength:,} bp)")
+
+        for i in range(0, sequenceLength, args.chunk_size):
+            sub_seq = sequences.fetch(sequence_name, i, i + args.chunk_size)
+            chunk_view[:len(sub_seq)] = sub_seq
+            # every result is read before the next chunk overwrites the shared one
+            tasks = list(window_ranges(len(sub_seq), args.width, args.spacing))
+            for (offset, length, windows), counts in zip(tasks, pool.imap(process_range, tasks)):
+                starts, ends = range_windows(i + offset, length, windows, args.width, args.spacing)
+                yield sequence_name, starts, ends, counts
+            del sub_seq
+
+# Writes the counts of range_counts in the long layout (a Sequence, Bin, Start, End, Count row per bin and window) or
+# the wide layout (a Spectra row per window with a column per bin, also as .gz or .spectra)
+def write_counts(args, pool, chunk_block, bin_names):
+    if args.layout == "wide":
+        with spectral.openSpectraWriter(args.output, bin_names, mer_size=args.mer_size, canonical=args.complement,
+                                        width=args.width, spacing=args.spacing) as spectraWriter:
+            for sequence_name, starts, ends, counts in range_counts(args, pool, chunk_block):
+                spectraWriter.writeBlock([os.path.basename(args.input), sequence_name], starts + 1, ends, counts)
+        return
+
+    # Prepare output
+    with open(args.output, "w", newline="") as fileOutput:
+        tsvWriter = csv.writer(fileOutput, delimiter="\t")
+        tsvWriter.writerow(["Sequence", "Bin", "Start", "End", "Count"])
+        for sequence_name, starts, ends, counts in range_counts(args, pool, chunk_block):
+            # To maintain compatibility with multi-pass output, we write rows for all bins
+            tsvWriter.writerows([sequence_name, bin_name, start + 1, end, count]
+                                for start, end, row in zip(starts.tolist(), ends.tolist(), counts.tolist())
+                                for bin_name, count in zip(bin_names, row))
 
 def main():
     # CLI arguments
@@ -59,7 +194,8 @@ def main():
     parser.add_argument('-q', '--query', required=True, help='Ranked query table file (tsv)')
     parser.add_argument('-w', '--width', type=int, default=3000, help='Window width [default 3000]')
     parser.add_argument('-s', '--spacing', type=int, default=3000, help='Window spacing [default 3000]')
-    parser.add_argument('-o', '--output', default='mass_query_report.tsv', help='Output TSV file')
+    parser.add_argument('-o', '--output', default='mass_query_report.tsv', help='Output TSV file, or with --layout wide .gz for an indexed bgzip tsv or .spectra for the binary store')
+    parser.add_argument('--layout', choices=['long', 'wide'], default='long', help='long writes a row per bin and window, wide a row per window with a column per bin [default long]')
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose mode')
     parser.add_argument('-c', '--complement', action='store_true', help='Include reverse complements in kmer bins [default False]')
     parser.add_argument('-m', '--mer-size', dest='mer_size', type=int, help='kmer size in query [default 20]', default=20)
@@ -84,6 +220,12 @@ def main():
     elif not os.path.exists(args.query):
         logger.error(f"Couldn't find input query file '{args.query}'")
         return
+    elif not 0 < args.mer_size <= MAX_MER_SIZE:
+        logger.error(f"Mer size must be between 1 and {MAX_MER_SIZE}")
+        return
+    elif args.layout == "long" and args.output.endswith((spectral.SPECTRA_EXTENSION, ".gz")):
+        logger.error("The long layout can only be output as tsv, use --layout wide for .gz or .spectra output")
+        return
 
     # If input chunksize and window size are not compatible, lower chunksize to the next compatible length
     if args.chunk_size % args.width != 0:
@@ -91,9 +233,7 @@ def main():
 
     # Count total kmers
     logger.info("Counting kmers in query file...")
-    with open(args.query) as f:
-        f.readline() # skip header
-        tableLength = sum(1 for _ in f)
+    tableLength = table_rows(args.query)
 
     logger.info(f"Query has {tableLength:,} kmers")
 
@@ -107,61 +247,28 @@ def main():
 
     # Map kmers to bins
     logger.info("Loading kmers into bins...")
-    kmer_map = defaultdict(list)
-    bin_names = []
-    for b in interest_bins:
-        start_idx = int(b / 100 * tableLength)
-        end_idx = int(min(100, b + step) / 100 * tableLength)
-        bin_name = f"pct{b + step:03d}"
-        bin_names.append(bin_name)
-
-        with open(args.query) as f:
-            f.readline() # skip header
-            for idx, line in enumerate(f):
-                if idx < start_idx: continue
-                if idx >= end_idx: break
-                kmer = line.strip().split("\t")[0].upper()
-                kmer_map[kmer].append(bin_name)
-                if args.complement:
-                    kmer_map[rc(kmer)].append(bin_name)
-
-    logger.info(f"Loaded {len(kmer_map):,} unique kmers across {len(bin_names)} bins")
-
-    # Prepare for parallel processing
-    pool = multiprocessing.Pool(processes=args.threads, initializer=init_worker, initargs=(kmer_map, args.mer_size, bin_names))
+    bin_names = [f"pct{b + step:03d}" for b in interest_bins]
+    ranges = [(int(b / 100 * tableLength), int(min(100, b + step) / 100 * tableLength)) for b in interest_bins]
+    kmers, kmer_bins = build_kmer_table(*load_bins(args.query, ranges, args.mer_size, args.complement))
+    logger.info(f"Loaded {len(np.unique(kmers)):,} unique kmers across {len(bin_names)} bins")
 
-    # Prepare output
-    with open(args.output, "w", newline="") as fileOutput:
-        tsvWriter = csv.writer(fileOutput, delimiter="\t")
-        tsvWriter.writerow(["Sequence", "Bin", "Start", "End", "Count"])
+    # the table is shared read-only with every worker instead of being copied into each one, and each chunk of sequence
+    # is placed in shared memory once so that workers only receive the (offset, length) of the windows they count
+    table_blocks, table = share_arrays(kmers, kmer_bins)
+    del kmers, kmer_bins
+    chunk_blocks, chunk = share_arrays(np.zeros(args.chunk_size, dtype=np.uint8))
+    pool = multiprocessing.Pool(processes=args.threads, initializer=init_worker,
+                                initargs=(table, chunk, args.mer_size, bin_names, args.width, args.spacing))
 
-        # Scan genome once
-        for record in SeqIO.parse(args.input, args.format):
-            sequence_name = record.id
-            sequenceLength = len(record)
-            if sequenceLength < args.minimum_size:
-                continue
-
-            logger.info(f"Processing sequence {sequence_name} ({sequenceLength:,} bp)")
-
-            if sequenceLength > args.chunk_size:
-                for i in range(0, sequenceLength, args.chunk_size):
-                    sub_seq = str(record.seq[i:i + args.chunk_size]).upper()
-                    tasks = window_tasks(sub_seq, args.width, args.spacing, sequence_name, offset=i)
-                    for result_rows in pool.imap(process_window, tasks):
-                        for row in result_rows:
-                            tsvWriter.writerow(row)
-                    del sub_seq
-            else:
-                seq_str = str(record.seq).upper()
-                tasks = window_tasks(seq_str, args.width, args.spacing, sequence_name)
-                for result_rows in pool.imap(process_window, tasks):
-                    for row in result_rows:
-                        tsvWriter.writerow(row)
-                del seq_str
-
-    pool.close()
-    pool.join()
+    try:
+        write_counts(args, pool, chunk_blocks[0], bin_names)
+    finally:
+        pool.close()
+        pool.join()
+        for block in table_blocks + chunk_blocks:
+            block.unlink()
+    for block in table_blocks + chunk_blocks:
+        block.close()
     logger.info(f"Execution time in seconds: {time.time() - startTime:.2f}")
 
 if __name__ == "__main__":
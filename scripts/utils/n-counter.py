@@ -2,27 +2,36 @@
 import argparse
 import os
 import time
-from Bio import SeqIO, Seq
 import csv
 import sys
 import logging
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import spectral
 
-def find_N_regions(fasta_file, output_tsv):
+def find_N_regions(fasta_file, output_tsv, sequence_format="fasta", chunk_size=30000000):
+    sequences = spectral.openSequences(fasta_file, sequence_format)
     with open(output_tsv, "w") as out:
-        for record in SeqIO.parse(fasta_file, "fasta"):
-            seq_name = record.id
-            seq_str = str(record.seq).upper()
-
-            i = 0
-            while i < len(seq_str):
-                if seq_str[i] == "N":
-                    start = i + 1  # 1-based index
-                    while i < len(seq_str) and seq_str[i] == "N":
-                        i += 1
-                    end = i  # still 1-based
+        for seq_name in sequences.keys():
+            # N runs are found chunk by chunk; a run reaching the end of a chunk is held open for the next one
+            open_start = None
+            sequenceLength = sequences.length(seq_name)
+            for offset in range(0, sequenceLength, chunk_size):
+                chunk = sequences.fetch(seq_name, offset, offset + chunk_size)
+                isN = np.concatenate(([False], (chunk == ord("N")) | (chunk == ord("n")), [False]))
+                edges = np.flatnonzero(isN[1:] != isN[:-1]) + offset
+                runs = list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+                if open_start is not None and (not runs or runs[0][0] != offset):
+                    runs.insert(0, (open_start, offset))
+                for start, end in runs:
+                    if open_start is not None and start == offset:
+                        start = open_start
+                    open_start = None
+                    if end == offset + len(chunk) and end < sequenceLength:
+                        open_start = start
+                        continue
+                    start += 1  # 1-based index
                     out.write(f"{seq_name}\tn-counter\tngap\t{start}\t{end}\t.\t+\t.\tNGAP:{end-start+1}bp\n")
-                else:
-                    i += 1
 
 
 parser = argparse.ArgumentParser(description="Kmer Mass Query: localize percentile kmers in genomic sequences (multi-pass)")
@@ -44,5 +53,5 @@ if not os.path.exists(args.input):
     exit()
 
 
-find_N_regions(args.input, args.output)
+find_N_regions(args.input, args.output, args.format)
 logger.info(f"Execution time in seconds: {time.time() - startTime:.2f}")
\ No newline at end of file
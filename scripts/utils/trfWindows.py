@@ -8,10 +8,12 @@ import os
 import time
 
 import pandas
-from Bio import SeqIO, Seq
 import re
+import sys
 import pandas as pd
 import csv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import spectral
 
 # Frame shift checks the outer bounds fo each window, then returns a content proportion of how many bases are within a repeat
 def frameShift(values):
@@ -47,7 +49,7 @@ elif not os.path.exists(args.input_fasta):
 
 sequences = {}
 try:
-    sequences = SeqIO.index(args.input_fasta, 'fasta')
+    sequences = spectral.openSequences(args.input_fasta, 'fasta')
     if len(sequences.keys()) == 0:
         logging.error(
             f"Sequence file '{args.input_fasta}' could not be loaded in fasta format or has incorrectly formatted sequences")
@@ -61,7 +63,7 @@ with open(args.output_table, 'w', newline='') as fileOutput:
     tsvWriter = csv.writer(fileOutput, delimiter='\t')
     tsvWriter.writerow(['Library', 'Sequence', 'Start', 'End', 'Proportion'])
     for group in table:
-        sequenceLength = len(sequences[group[0]])
+        sequenceLength = sequences.length(group[0])
 
         sequenceHits = [0] * sequenceLength
         for row in group[1].iterrows():
@@ -19,7 +19,7 @@ parserCount.add_argument('-i', '--input', dest='input_sequence', type=str, help=
 parserCount.add_argument('-f', '--format', dest='sequence_format', type=str, help='Input file type', default='fasta')
 parserCount.add_argument('-w', '--width', dest='width', type=int, help='Window width', default='10000')
 parserCount.add_argument('-s', '--spacing', dest='spacing', type=int, help='Window spacing', default='10000')
-parserCount.add_argument('-o', '--output', dest='output', type=str, help='Output tsv file', default='spectra_report.tsv')
+parserCount.add_argument('-o', '--output', dest='output', type=str, help='Output tsv file, .gz for an indexed bgzip tsv, or .spectra for the binary store', default='spectra_report.tsv')
 parserCount.add_argument('-c', '--complement', dest='complement', action='store_true', help='Complement sequence file name. If set, calculates spectra for sequence complement (not reversed-complemented)', default=False)
 parserCount.add_argument('-l', '--libraries', dest='libraries', action='store_true', help='Sequence names include multiple libraries, prefixed by LIBRARY_', default=False)
 parserCount.add_argument('-p', '--proportions', dest='proportions', action='store_true', help='Return Spectra 3-mer proportions instead of raw counts', default=False)
@@ -28,6 +28,11 @@ parserCount.add_argument('-v', '--verbose', dest='verbose', action='store_true',
 parserCount.add_argument('-n', '--no-overlap', dest='overlap', action='store_false', help='Count base pairs in repetitive runs of nucleotides only once.', default=True)
 parserCount.add_argument('-k', '--chunk-size', dest='chunk_size', type=int, help='Max chunk size to work on', default=30000000)
 parserCount.add_argument('--minimum-size', dest='minimum_size', type=int, help='Minimum sequence size to include.', default=15000)
+parserCount.add_argument('-t', '--threads', dest='threads', type=int, help='Number of worker processes counting chunks in parallel', default=1)
+parserCount.add_argument('--pyramid', dest='pyramid', type=int, help='Also write N coarser levels (2x, 4x, ... windows summed) next to the output, as OUTPUT.x2.tsv, OUTPUT.x4.tsv, ...', default=0)
+parserCount.add_argument('--cache', dest='cache', type=str, help='Directory caching counted windows of each chunk by sequence content, count options and chunk position, reused by later runs')
+parserCount.add_argument('--cache-size', dest='cache_size', type=int, help='Cache size limit in MB, least recently used chunks are evicted first', default=4096)
+parserCount.add_argument('-e', '--engine', dest='engine', type=str, choices=['numpy', 'python'], help='Counting engine. numpy counts whole chunks with 2-bit encoded k-mers, python counts window by window', default='numpy')
 
 parserQuery = subparsers.add_parser("query", description="Generate tsv file of spectra counts")
 parserQuery.add_argument('-i', '--input', dest='input_sequence', type=str, help='Input sequence file', required=True)
@@ -35,18 +40,19 @@ parserQuery.add_argument('-f', '--format', dest='sequence_format', type=str, hel
 parserQuery.add_argument('-q', '--query', dest='query', type=str, help='Query sequences, separated by commas', required=True)
 parserQuery.add_argument('-w', '--width', dest='width', type=int, help='Window width', default='3000')
 parserQuery.add_argument('-s', '--spacing', dest='spacing', type=int, help='Window spacing', default='3000')
-parserQuery.add_argument('-o', '--output', dest='output', type=str, help='Output tsv file', default='spectra_report.tsv')
+parserQuery.add_argument('-o', '--output', dest='output', type=str, help='Output tsv file, .gz for an indexed bgzip tsv, or .spectra for the binary store', default='spectra_report.tsv')
 parserQuery.add_argument('-l', '--libraries', dest='libraries', action='store_true', help='Sequence names include multiple libraries, prefixed by LIBRARY_', default=False)
 parserQuery.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose mode', default=False)
 parserQuery.add_argument('-m', '--memory', dest='memory', action='store_true', help='Use memory-conservation mode', default=False)
 parserQuery.add_argument('-d', '--consolidate', dest='consolidate', action='store_true', help='Consolidate all records into single column', default=False)
 parserQuery.add_argument('-c', '--complement', dest='complement', action='store_true', help='Complement sequence file name. If set, calculates spectra for sequence complement (not reversed-complemented)', default=False)
 parserQuery.add_argument('-n', '--no-overlap', dest='overlap', action='store_false', help='Verbose mode', default=True)
-parserQuery.add_argument('-k', '--chunk-size', dest='overlap', action='store_false', help='Max chunk size to work on', default=30000000)
+parserQuery.add_argument('-k', '--chunk-size', dest='chunk_size', type=int, help='Max chunk size to work on', default=30000000)
+parserQuery.add_argument('-t', '--threads', dest='threads', type=int, help='Number of worker processes counting chunks in parallel', default=1)
 
 parserCollate = subparsers.add_parser('collate', description='Collate multiple spectra output tsv into a multi-library tsv')
 parserCollate.add_argument('-i', '--input', dest='input_tsvs', help='Input spectra tsvs, separated by spaces', nargs='*', required=True)
-parserCollate.add_argument('-o', '--output', dest='output', help='Output spectra tsv', default='collated_spectra.tsv')
+parserCollate.add_argument('-o', '--output', dest='output', help='Output spectra tsv, .gz for an indexed bgzip tsv, or .spectra for the binary store', default='collated_spectra.tsv')
 parserCollate.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose mode', default=False)
 
 parserTransform = subparsers.add_parser('transform', description='Transform spectra data for additional insight')
@@ -56,9 +62,10 @@ parserTransform.add_argument('-r', '--weighted-filter', dest='weighted_filter',
 parserTransform.add_argument('-n', '--weighted-norm', dest='weighted_normalization', action='store_true', help='Normalize spectra frequencies for each window by the frequencies for the whole sequence', default=False)
 parserTransform.add_argument('-f', '--freq', dest='frequencies', action='store_true', help='Mark this is Spectra data is already in frequencies', default=False)
 parserTransform.add_argument('-c', '--convert', dest='convert', action='store_true', help='Convert between counts and frequencies', default=False)
-parserTransform.add_argument('-s', '--window-resize', dest='resize_window', type=int, help='Resize windows to summarize N for every 1 window')
+parserTransform.add_argument('-s', '--window-resize', dest='resize_window', type=int, help='Resize windows to summarize N for every 1 window, read from count --pyramid levels when available')
 parserTransform.add_argument('-p', '--print', dest='print', action='store_true', help='Print global frequencies', default=False)
 parserTransform.add_argument('-y', '--simplify', dest='simplify', action='store_true', help='Simplify forward and reverse-complement counts per window', default=False)
+parserTransform.add_argument('-k', '--chunk-rows', dest='chunk_rows', type=int, help='Stream the input N rows at a time, in memory bounded by N instead of the input size')
 parserTransform.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='verbose mode', default=False)
 
 parserPlot = subparsers.add_parser('plot', description='Plot spectra profiles')
@@ -66,15 +73,21 @@ parserPlot.add_argument('-i', '--input', dest='input_tsv', type=str, help='Input
 parserPlot.add_argument('-o', '--output', dest='output', type=str, help='Output spectra plot', default='spectra_plot.png')
 parserPlot.add_argument('-z', '--zoom', dest='zoom_width', type=str, help='Plot only a portion of the windows from between X,Y')
 parserPlot.add_argument('-s', '--sequence', dest='sequence', type=str, help='Plot only sequences matching Name1,Name2,Name3')
+parserPlot.add_argument('-r', '--resolution', dest='resolution', type=int, help='Plot windows of about N bases, summed from the input windows or read from count --pyramid levels')
 parserPlot.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose mode', default=False)
 
 parserAnalyze = subparsers.add_parser('analyze', description='Analyze spectra profiles')
 parserAnalyze.add_argument('-i', '--input', dest='input_tsv', type=str, help='Input spectra tsv', required=True)
 parserAnalyze.add_argument('-o', '--output', dest='output_prefix', type=str, help='Output prefix', default=False)
 parserAnalyze.add_argument('-p', '--penalty', dest='penalty', type=float, help='Ruptures breakpoint penalty criterion.', default=1000000)
+parserAnalyze.add_argument('-P', '--penalties', dest='penalties', type=str, help='Detect breakpoints for several penalties in one run, as comma separated values and LOW:HIGH:N ranges of N log-spaced penalties. Writes the bins of each penalty and the number of segments per penalty', default=None)
 parserAnalyze.add_argument('-a', '--aligned', dest='is_aligned', action='store_true', help='Check for if input tsv comes from alignment or from sequence data', default=False)
 parserAnalyze.add_argument('-s', '--size', dest='size', type=int, help='Minimum windows to be considered a novel segment', default=5)
 parserAnalyze.add_argument('-f', '--frequencies', dest='frequency', action='store_true', help='Process breaks by frequencies instead of raw counts', default=False)
+parserAnalyze.add_argument('-b', '--backend', dest='backend', type=str, choices=['kernel', 'pelt', 'binseg', 'coarse'], help='Breakpoint method: kernel (ruptures KernelCPD), pelt (same segmentation from L2 cumulative sums), binseg (binary segmentation) or coarse (pelt on summed windows, refined at full resolution)', default='kernel')
+parserAnalyze.add_argument('--coarse-factor', dest='coarse_factor', type=int, help='Windows summed per coarse window by the coarse backend', default=8)
+parserAnalyze.add_argument('-t', '--threads', dest='threads', type=int, help='Number of worker processes detecting breakpoints of different sequences in parallel', default=1)
+parserAnalyze.add_argument('-r', '--resolution', dest='resolution', type=int, help='Analyze windows of about N bases, summed from the input windows or read from count --pyramid levels')
 parserAnalyze.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose mode', default=False)
 
 args = parser.parse_args()
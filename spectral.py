@@ -1,17 +1,30 @@
 import ruptures as rpt
 import pandas as pd
 import numpy as np
-from Bio import Seq
-from collections import Counter
+from collections import Counter, deque
 import itertools
+import math
+import mmap
+import os
+import logging
+import scipy.sparse as sparse
+import csv
+import json
+import struct
+import io
+import hashlib
+import re
+from Bio import SeqIO
+from Bio import bgzf
+from collections import namedtuple
 
 def setMers(merSize=3):
     bases = ["A", "C", "G", "T"]
     return ["".join(a) for a in list(itertools.product(bases, repeat=merSize))]
-# Shorthand for string reverse-complement using Biopython
+# Shorthand for string reverse-complement, using the IUPAC complements Biopython uses
+RC_TRANS = str.maketrans("ACGTRYKMBVDHSWNacgtrykmbvdhswn", "TGCAYRMKVBHDSWNtgcayrmkvbhdswn")
 def rc(sequence):
-    sequence = Seq.Seq(sequence)
-    return str(sequence.reverse_complement())
+    return str(sequence).translate(RC_TRANS)[::-1]
 
 def canonical(kmer):
     return min(kmer, rc(kmer))
@@ -51,19 +64,24 @@ def validate(df):
 # Simplify bi-directional frequencies/counts to unidirectional
 def simplify(spectra, index=4, dim=64):
     simpleQueries = {}
+    partners = set()
     for query in list(spectra.columns)[index:index + dim]:
-        if query not in list(simpleQueries.values()) or rc(query) not in list(simpleQueries.keys()):
+        if query not in partners or rc(query) not in simpleQueries:
             simpleQueries[query] = rc(query)
-    for mer in simpleQueries:
-        if simpleQueries[mer] != mer:
-            spectra[mer] += spectra[simpleQueries[mer]]
-    return spectra.drop(columns=[simpleQueries[a] for a in simpleQueries if a != simpleQueries[a]])
+            partners.add(rc(query))
+    # the first of each reverse-complement pair keeps the sum of both columns; palindromes are kept as they are
+    mers = [a for a in simpleQueries if simpleQueries[a] != a]
+    if mers:
+        spectra[mers] = spectra[mers].to_numpy() + spectra[[simpleQueries[a] for a in mers]].to_numpy()
+    return spectra.drop(columns=[simpleQueries[a] for a in mers])
 
 # Counts the spectra of a sequence
 def windowCount(seq, complement=False):
     windowSeq, queries, start, end, headers = seq
     windowSeq = str(windowSeq)
-    counts = Counter(windowSeq[i:i + 3] for i in range(len(windowSeq) - 2))
+    counts = Counter()
+    for merSize in set(len(q) for q in queries):
+        counts.update(windowSeq[i:i + merSize] for i in range(len(windowSeq) - merSize + 1))
     if complement:
         counts = collapseRC(counts, queries)
         queries = sorted(set(min(q, rc(q)) for q in queries))
@@ -71,6 +89,328 @@ def windowCount(seq, complement=False):
     #return seq[4] + [seq[2] + 1, seq[2] + len(seq[0]) if seq[2] + len(seq[0]) < seq[3] else seq[3]] + [
     #           seq[0].count_overlap(a) for a in seq[1]]
 
+# Maps function over tasks in a multiprocessing pool (or serially when pool is None), yielding (task, result) in task
+# order while keeping at most inFlight tasks submitted but not yet consumed
+def orderedImap(pool, function, tasks, inFlight=2):
+    if pool is None:
+        for task in tasks:
+            yield task, function(task)
+        return
+    pending = deque()
+    for task in tasks:
+        pending.append((task, pool.apply_async(function, (task,))))
+        if len(pending) >= inFlight:
+            task, result = pending.popleft()
+            yield task, result.get()
+    while pending:
+        task, result = pending.popleft()
+        yield task, result.get()
+
+# 2-bit base codes (A=0, C=1, G=2, T=3); every other byte, including N and IUPAC codes, is INVALID_BASE
+INVALID_BASE = 4
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for baseCode, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = baseCode
+    BASE_CODES[ord(base.lower())] = baseCode
+# Upper bound on matrix cells (windows x 4^k) built at once by the numpy engine
+MAX_MATRIX_CELLS = 1 << 25
+# Upper bound on bases whose k-mer indices and positions are expanded at once (tens of bytes per base)
+MAX_BATCH_BASES = 1 << 22
+# Largest k counted into dense 4^k columns (65,536); larger k are counted as sparse per-window matrices
+DENSE_MAX_MER = 8
+# Largest k whose 2-bit indices fit sparse matrix column indices
+SPARSE_MAX_MER = 31
+
+# Encode a sequence (str, bytes or uint8 array) to 2-bit base codes
+def encodeSequence(sequence):
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii", errors="replace")
+    if isinstance(sequence, (bytes, bytearray, memoryview)):
+        sequence = np.frombuffer(sequence, dtype=np.uint8)
+    return BASE_CODES[sequence]
+
+# Rolling k-mer indices for every position of encoded sequence, with a mask of k-mers made only of ACGT
+def kmerIndices(codes, merSize=3):
+    positions = len(codes) - merSize + 1
+    dtype = np.uint32 if merSize <= 16 else np.uint64
+    if positions <= 0:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=bool)
+    invalid = np.zeros(len(codes) + 1, dtype=np.int32 if len(codes) < 2 ** 31 else np.int64)
+    np.cumsum(codes >= INVALID_BASE, out=invalid[1:])
+    valid = invalid[merSize:] == invalid[:positions]
+    indices = np.zeros(positions, dtype=dtype)
+    shift = dtype(2)
+    for offset in range(merSize):
+        indices <<= shift
+        indices |= codes[offset:offset + positions] & 3
+    return indices, valid
+
+# Window boundaries (relative to the encoded sequence) used by window_tasks in count
+def windowBounds(length, width, spacing):
+    starts = np.arange(0, length, spacing, dtype=np.int64)
+    return starts, np.minimum(starts + width, length)
+
+# Windows per batch: at most batchSize, and few enough that a batch spans at most MAX_BATCH_BASES bases (or one window)
+def baseBatchSize(batchSize, width, spacing):
+    return max(1, min(batchSize, (MAX_BATCH_BASES - width) // spacing + 1))
+
+# Occurrences that str.count's greedy left-to-right scan skips because they overlap an earlier match.
+# groups, positions and lengths describe pattern occurrences sorted by group, then position, where a group is one
+# pattern in one window. Returns (groups, skipped) for every run of occurrences that each overlap the previous one
+def greedySkips(groups, positions, lengths):
+    close = (groups[1:] == groups[:-1]) & (positions[1:] - positions[:-1] < lengths[:-1])
+    runIds = np.cumsum(np.concatenate(([True], ~close))) - 1
+    runLengths = np.bincount(runIds)
+    members = runLengths[runIds] > 1
+    if not members.any():
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    runIds, positions, lengths = runIds[members], positions[members], lengths[members]
+    heads = np.flatnonzero(np.concatenate(([True], runIds[1:] != runIds[:-1])))
+    runEnds = np.repeat(np.append(heads[1:], len(runIds)), np.diff(np.append(heads, len(runIds))))
+    # each match jumps to the first occurrence of its run at or past its own end
+    keys = runIds * (positions.max() + lengths.max() + 1) + positions
+    jump = np.searchsorted(keys, keys + lengths)
+    jump[jump >= runEnds] = len(keys)
+    # matches kept per run = length of the jump chain from the run head, found by pointer doubling
+    jump = np.append(jump, len(keys))
+    kept = np.ones(len(keys) + 1, dtype=np.int64)
+    kept[-1] = 0
+    while (jump[:-1] != len(keys)).any():
+        kept = kept + kept[jump]
+        jump = jump[jump]
+    return groups[members][heads], runLengths[runIds[heads]] - kept[heads]
+
+# Count k-mers in windows that do not overlap, so every k-mer belongs to at most one window.
+# Without overlap, k-mers are counted like str.count, skipping occurrences that overlap an earlier one
+def binnedWindowCounts(indices, valid, starts, ends, merSize, spacing, dim, overlap=True):
+    first, last = starts[0], max(ends[-1] - merSize + 1, starts[0])
+    position = np.arange(first, last, dtype=np.int64)
+    window = (position - first) // spacing
+    keep = valid[first:last] & (position + merSize <= ends[window])
+    mers = indices[first:last]
+    flat = window[keep] * dim + mers[keep]
+    counts = np.bincount(flat, minlength=len(starts) * dim).reshape(len(starts), dim).astype(np.uint32)
+    if not overlap and merSize > 1:
+        # only occurrences sharing their k-mer with a neighbour closer than k can be skipped
+        candidate = np.zeros(len(position), dtype=bool)
+        for distance in range(1, min(merSize, len(position))):
+            near = keep[distance:] & keep[:-distance] & (mers[distance:] == mers[:-distance]) & (window[distance:] == window[:-distance])
+            candidate[distance:] |= near
+            candidate[:-distance] |= near
+        groups = window[candidate] * dim + mers[candidate]
+        order = np.argsort(groups, kind="stable")
+        groups, skipped = greedySkips(groups[order], position[candidate][order], np.full(len(order), merSize))
+        counts -= np.bincount(groups, weights=skipped, minlength=counts.size).reshape(counts.shape).astype(np.uint32)
+    return counts
+
+# Count k-mers in overlapping windows as differences of cumulative counts over blocks of blockSize positions.
+# Window starts and full-width ends fall on block boundaries, so each base is counted once however much windows overlap
+def prefixWindowCounts(indices, valid, starts, ends, merSize, blockSize, dim):
+    firstBlock = starts[0] // blockSize
+    blocks = -(-ends[-1] // blockSize) - firstBlock
+    first, last = firstBlock * blockSize, min((firstBlock + blocks) * blockSize, len(indices))
+    position = np.arange(first, last, dtype=np.int64)
+    keep = valid[first:last]
+    flat = ((position[keep] - first) // blockSize) * dim + indices[first:last][keep]
+    prefix = np.zeros((blocks + 1, dim), dtype=np.uint32)
+    prefix[1:] = np.bincount(flat, minlength=blocks * dim).reshape(blocks, dim)
+    np.cumsum(prefix, axis=0, out=prefix)
+    counts = prefix[-(-ends // blockSize) - firstBlock] - prefix[starts // blockSize - firstBlock]
+    # remove k-mers that start inside a window but run past its end
+    tailStarts = np.maximum(ends - merSize + 1, starts)
+    tail = tailStarts[:, None] + np.arange(merSize - 1)
+    tailKeep = (tail < ends[:, None]) & (tail < len(indices))
+    tailKeep[tailKeep] = valid[tail[tailKeep]]
+    rows = np.broadcast_to(np.arange(len(starts))[:, None], tail.shape)
+    flat = rows[tailKeep] * dim + indices[tail[tailKeep]]
+    counts -= np.bincount(flat, minlength=counts.size).reshape(counts.shape).astype(np.uint32)
+    return counts
+
+# Count all k-mers of encoded sequence in windows, yielding (starts, ends, counts) blocks of windows.
+# counts has one column per k-mer in setMers order, matching windowCount (or windowCountNoOverlap without overlap)
+def countKmerWindows(codes, merSize=3, width=10000, spacing=10000, overlap=True):
+    dim = 4 ** merSize
+    starts, ends = windowBounds(len(codes), width, spacing)
+    blockSize = math.gcd(width, spacing)
+    # cumulative counts pay dim per block, recounting pays width / spacing per base
+    usePrefix = spacing < width and dim * spacing < width * blockSize
+    if spacing >= width:
+        batchSize = max(1, MAX_MATRIX_CELLS // dim)
+    elif usePrefix:
+        batchSize = max(1, (MAX_MATRIX_CELLS // dim * blockSize - width) // spacing + 1)
+    else:
+        batchSize = max(1, MAX_MATRIX_CELLS // dim)
+    batchSize = baseBatchSize(batchSize, width, spacing)
+    for batchStart in range(0, len(starts), batchSize):
+        batchStarts = starts[batchStart:batchStart + batchSize]
+        batchEnds = ends[batchStart:batchStart + batchSize]
+        # k-mers are indexed over the bases of one batch at a time, so memory does not grow with the chunk.
+        # Batches start on a window start, which keeps the prefix blocks aligned
+        first = batchStarts[0]
+        indices, valid = kmerIndices(codes[first:batchEnds[-1]], merSize)
+        localStarts, localEnds = batchStarts - first, batchEnds - first
+        if spacing >= width:
+            counts = binnedWindowCounts(indices, valid, localStarts, localEnds, merSize, spacing, dim, overlap)
+        elif not overlap:
+            # non-overlapping counts depend on where each window starts, so overlapping windows are counted one at a time
+            counts = np.concatenate([binnedWindowCounts(indices, valid, localStarts[row:row + 1], localEnds[row:row + 1], merSize, width, dim, overlap) for row in range(len(localStarts))])
+        elif usePrefix:
+            counts = prefixWindowCounts(indices, valid, localStarts, localEnds, merSize, blockSize, dim)
+        else:
+            counts = np.zeros((len(batchStarts), dim), dtype=np.uint32)
+            for row, (start, end) in enumerate(zip(localStarts, localEnds)):
+                stop = max(end - merSize + 1, start)
+                counts[row] = np.bincount(indices[start:stop][valid[start:stop]].astype(np.int64), minlength=dim)
+        yield batchStarts, batchEnds, counts
+
+# Count k-mers in windows as sparse (windows x 4^k) CSR matrices, for k too large for dense columns.
+# Yields (starts, ends, counts) blocks like countKmerWindows
+def countKmerWindowsSparse(codes, merSize=12, width=10000, spacing=10000, overlap=True):
+    starts, ends = windowBounds(len(codes), width, spacing)
+    batchSize = baseBatchSize(max(1, MAX_MATRIX_CELLS // max(width, 1)), width, spacing)
+    for batchStart in range(0, len(starts), batchSize):
+        batchStarts = starts[batchStart:batchStart + batchSize]
+        batchEnds = ends[batchStart:batchStart + batchSize]
+        first = batchStarts[0]
+        indices, valid = kmerIndices(codes[first:batchEnds[-1]], merSize)
+        # concatenate the k-mer start positions (relative to the batch) of every window, then sort each window's k-mers
+        lengths = np.maximum(batchEnds - merSize + 1 - batchStarts, 0)
+        rows = np.repeat(np.arange(len(batchStarts)), lengths)
+        position = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(batchStarts - first, lengths)
+        keep = valid[position]
+        rows, mers, position = rows[keep], indices[position[keep]].astype(np.int64), position[keep]
+        order = np.lexsort((position, mers, rows))
+        rows, mers, position = rows[order], mers[order], position[order]
+        first = np.flatnonzero(np.concatenate(([True], (rows[1:] != rows[:-1]) | (mers[1:] != mers[:-1])))[:len(rows)])
+        data = np.diff(np.append(first, len(rows))).astype(np.uint32)
+        if not overlap and len(rows):
+            groups = np.cumsum(np.isin(np.arange(len(rows)), first)) - 1
+            groups, skipped = greedySkips(groups, position, np.full(len(rows), merSize))
+            data -= np.bincount(groups, weights=skipped, minlength=len(data)).astype(np.uint32)
+        indptr = np.zeros(len(batchStarts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[first], minlength=len(batchStarts)), out=indptr[1:])
+        counts = sparse.csr_matrix((data, mers[first], indptr), shape=(len(batchStarts), 4 ** merSize))
+        yield batchStarts, batchEnds, counts
+
+# Reverse-complement k-mer indices without leaving 2-bit space
+def reverseComplementIndices(indices, merSize=3):
+    indices = np.asarray(indices, dtype=np.uint64)
+    reverse = np.zeros(len(indices), dtype=np.uint64)
+    for offset in range(merSize):
+        reverse = (reverse << np.uint64(2)) | (np.uint64(3) - ((indices >> np.uint64(2 * offset)) & np.uint64(3)))
+    return reverse
+
+# Forward and reverse-complement k-mer indices of every canonical (lexicographically smaller) k-mer, in setMers order.
+# Palindromes pair with themselves, matching mapCanonicalMers
+def canonicalPairs(merSize=3):
+    indices = np.arange(4 ** merSize, dtype=np.uint64)
+    reverse = reverseComplementIndices(indices, merSize)
+    keep = indices <= reverse
+    return indices[keep].astype(np.int64), reverse[keep].astype(np.int64)
+
+# Fold a counts block from countKmerWindows(Sparse) onto canonical k-mers in one vectorized step.
+# Dense blocks keep one column per canonical k-mer; sparse blocks keep canonical k-mer indices as columns
+def foldCanonical(counts, merSize=3):
+    if sparse.issparse(counts):
+        mers = counts.indices.astype(np.uint64)
+        reverse = reverseComplementIndices(mers, merSize)
+        data = np.where(mers == reverse, counts.data * 2, counts.data).astype(counts.data.dtype)
+        folded = sparse.csr_matrix((data, np.minimum(mers, reverse).astype(np.int64), counts.indptr), shape=counts.shape)
+        folded.sum_duplicates()
+        return folded
+    forward, reverse = canonicalPairs(merSize)
+    return counts[:, forward] + counts[:, reverse]
+
+# Convert k-mer indices back to k-mer strings
+def decodeKmers(indices, merSize=3):
+    indices = np.asarray(indices, dtype=np.uint64)
+    shifts = np.arange(2 * (merSize - 1), -1, -2, dtype=np.uint64)
+    letters = np.frombuffer(b"ACGT", dtype=np.uint8)[(indices[:, None] >> shifts) & np.uint64(3)]
+    return np.ascontiguousarray(letters).view(f"S{merSize}").ravel().astype(str)
+
+# Longest query matched in 2-bit space by countQueryWindows. Longer queries, and queries with letters other than ACGT,
+# are counted on the window text instead
+QUERY_MAX_MER = 32
+
+# Bases of the lookup table that screens positions for any query before they are matched exactly (4^12 entries)
+QUERY_HEAD_MER = 12
+
+# Positions and numbers of every occurrence in encoded sequence of the queries with 2-bit indices and lengths.
+# The indices of the longest length are rolled once and their leading bases are looked up in a table of every query
+# start, so the whole query set costs one scan; only the positions found there are matched with a sorted lookup
+def queryOccurrences(codes, indices, lengths):
+    longest = int(lengths.max())
+    mers = kmerIndices(np.append(codes, np.full(longest - 1, INVALID_BASE, dtype=np.uint8)), longest)[0]
+    invalid = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes >= INVALID_BASE, out=invalid[1:])
+    headLength = min(longest, QUERY_HEAD_MER)
+    heads = np.zeros(4 ** headLength, dtype=bool)
+    for index, length in zip(indices.tolist(), lengths.tolist()):
+        if length >= headLength:
+            heads[index >> 2 * (length - headLength)] = True
+        else:
+            heads[(index << 2 * (headLength - length)) + np.arange(4 ** (headLength - length))] = True
+    candidates = np.flatnonzero(heads[mers >> mers.dtype.type(2 * (longest - headLength))])
+    positions, numbers = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for length in np.unique(lengths).tolist():
+        starts = candidates[candidates <= len(codes) - length]
+        members = np.flatnonzero(lengths == length)
+        members = members[np.argsort(indices[members])]
+        sortedIndices = indices[members].astype(mers.dtype)
+        prefixes = mers[starts] >> mers.dtype.type(2 * (longest - length))
+        slots = np.minimum(np.searchsorted(sortedIndices, prefixes), len(members) - 1)
+        hits = (invalid[starts + length] == invalid[starts]) & (sortedIndices[slots] == prefixes)
+        positions.append(starts[hits])
+        numbers.append(members[slots[hits]])
+    return np.concatenate(positions), np.concatenate(numbers)
+
+# Count queries of any length in windows of a sequence (str, bytes or uint8 array), yielding (starts, ends, counts)
+# blocks like countKmerWindows with one column per query. Occurrences are counted with overlaps like windowCount, or
+# like str.count (windowCountNoOverlap) without overlap
+def countQueryWindows(sequence, queries, width=10000, spacing=10000, overlap=True):
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii", errors="replace")
+    if isinstance(sequence, (bytes, bytearray, memoryview)):
+        sequence = np.frombuffer(sequence, dtype=np.uint8)
+    unique = list(dict.fromkeys(queries))
+    columns = [unique.index(query) for query in queries]
+    encoded = np.array([0 < len(query) <= QUERY_MAX_MER and set(query) <= set("ACGT") for query in unique], dtype=bool)
+    lengths = np.array([len(query) for query in unique], dtype=np.int64)
+    indices = np.array([int(kmerIndices(encodeSequence(query), len(query))[0][0]) if encoded[number] else 0
+                        for number, query in enumerate(unique)], dtype=np.uint64)
+    starts, ends = windowBounds(len(sequence), width, spacing)
+    batchSize = baseBatchSize(max(1, MAX_MATRIX_CELLS // max(spacing, width)), width, spacing)
+    for batchStart in range(0, len(starts), batchSize):
+        batchStarts = starts[batchStart:batchStart + batchSize]
+        batchEnds = ends[batchStart:batchStart + batchSize]
+        first = batchStarts[0]
+        counts = np.zeros((len(batchStarts), len(unique)), dtype=np.uint32)
+        if encoded.any():
+            members = np.flatnonzero(encoded)
+            positions, numbers = queryOccurrences(encodeSequence(sequence[first:batchEnds[-1]]), indices[members], lengths[members])
+            positions, numbers = positions + first, members[numbers]
+            # an occurrence counts in every window that starts at or before it and ends at or after its end
+            occurrenceLengths = lengths[numbers]
+            low = np.maximum(-(-(positions + occurrenceLengths - width) // spacing) - batchStart, 0)
+            high = np.minimum(positions // spacing - batchStart, len(batchStarts) - 1)
+            repeats = np.maximum(high - low + 1, 0)
+            windows = np.repeat(low, repeats) + np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+            positions, numbers, occurrenceLengths = np.repeat(positions, repeats), np.repeat(numbers, repeats), np.repeat(occurrenceLengths, repeats)
+            keep = positions + occurrenceLengths <= batchEnds[windows]
+            groups = windows[keep] * len(unique) + numbers[keep]
+            counts += np.bincount(groups, minlength=counts.size).reshape(counts.shape).astype(np.uint32)
+            if not overlap:
+                order = np.lexsort((positions[keep], groups))
+                groups, skipped = greedySkips(groups[order], positions[keep][order], occurrenceLengths[keep][order])
+                counts -= np.bincount(groups, weights=skipped, minlength=counts.size).reshape(counts.shape).astype(np.uint32)
+        if not encoded.all():
+            for row, (start, end) in enumerate(zip(batchStarts, batchEnds)):
+                window = sequence[start:end].tobytes().decode('ascii', errors='replace').upper()
+                for number in np.flatnonzero(~encoded):
+                    query = unique[number]
+                    counts[row, number] = sum(1 for match in re.finditer(f"(?={re.escape(query)})", window)) if overlap else window.count(query)
+        yield batchStarts, batchEnds, counts[:, columns]
+
 def windowCountNoOverlap(seq, complement=False):
     windowSeq, queries, start, end, headers = seq
     windowSeq = str(windowSeq)
@@ -78,76 +418,901 @@ def windowCountNoOverlap(seq, complement=False):
     #return seq[4] + [seq[2] + 1, seq[2] + len(seq[0]) if seq[2] + len(seq[0]) < seq[3] else seq[3]] + [
     #    seq[0].count(a) for a in seq[1]]
 
+# samtools faidx record: sequence length, byte offset of its first base, bases per line and bytes per line
+FaiRecord = namedtuple("FaiRecord", ["length", "offset", "linebases", "linewidth"])
+
+# Scan a FASTA file into .fai records. As with samtools faidx, every sequence line of a record but the last must have
+# the same length, otherwise a ValueError is raised
+def buildFai(path):
+    records = {}
+    name = None
+    position = 0
+    with open(path, 'rb') as fastaFile:
+        for line in fastaFile:
+            if line.startswith(b'>'):
+                if name is not None:
+                    records[name] = FaiRecord(length, offset, lineBases, lineWidth)
+                fields = line[1:].split(None, 1)
+                name = fields[0].decode() if fields else ''
+                if name in records:
+                    raise ValueError(f"Duplicate sequence name '{name}'")
+                offset, length, lineBases, lineWidth, ended = position + len(line), 0, 0, 0, False
+            else:
+                bases = len(line.rstrip(b'\r\n'))
+                if name is None and bases:
+                    raise ValueError("Sequence data found before the first header")
+                if bases == 0:
+                    ended = name is not None
+                elif ended:
+                    raise ValueError(f"Different line length in sequence '{name}'")
+                elif lineBases == 0:
+                    lineBases, lineWidth = bases, len(line)
+                elif bases > lineBases or (line.endswith(b'\n') and len(line) - bases != lineWidth - lineBases):
+                    raise ValueError(f"Different line length in sequence '{name}'")
+                elif bases < lineBases:
+                    ended = True
+                length += bases
+            position += len(line)
+    if name is not None:
+        records[name] = FaiRecord(length, offset, lineBases, lineWidth)
+    return records
+
+def readFai(path):
+    records = {}
+    with open(path) as faiFile:
+        for line in faiFile:
+            fields = line.rstrip('\n').split('\t')
+            records[fields[0]] = FaiRecord(*[int(a) for a in fields[1:5]])
+    return records
+
+def writeFai(records, path):
+    with open(path, 'w') as faiFile:
+        for name, record in records.items():
+            faiFile.write(f"{name}\t{record.length}\t{record.offset}\t{record.linebases}\t{record.linewidth}\n")
+
+# Memory-mapped FASTA file with samtools-compatible .fai random access. The .fai next to the FASTA is reused when it is
+# newer than the FASTA, and written there when it is missing or stale (if the directory is writable)
+class FastaFile:
+    def __init__(self, path):
+        self.path = path
+        faiPath = f"{path}.fai"
+        if os.path.exists(faiPath) and os.path.getmtime(faiPath) >= os.path.getmtime(path):
+            self.records = readFai(faiPath)
+        else:
+            self.records = buildFai(path)
+            try:
+                writeFai(self.records, faiPath)
+            except OSError:
+                logging.info(f"Could not write index '{faiPath}', keeping it in memory")
+        self.open()
+
+    def open(self):
+        self.buffer = np.zeros(0, dtype=np.uint8)
+        if os.path.getsize(self.path):
+            with open(self.path, 'rb') as fastaFile:
+                self.buffer = np.frombuffer(mmap.mmap(fastaFile.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
+    # worker processes re-map the file instead of pickling it
+    def __getstate__(self):
+        return {"path": self.path, "records": self.records}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        return self.records.keys()
+
+    def length(self, name):
+        return self.records[name].length
+
+    # Line-stripped bytes of [start, end), passed through table when given. Regions inside a single line are views of
+    # the mapped file; longer regions are gathered line by line into one new array
+    def region(self, name, start=0, end=None, table=None):
+        record = self.records[name]
+        end = record.length if end is None else min(end, record.length)
+        start = min(max(start, 0), end)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        lineBases, lineWidth = record.linebases, record.linewidth
+        firstLine, lastLine = start // lineBases, (end - 1) // lineBases
+        lineStart = record.offset + firstLine * lineWidth
+        tail = self.buffer[lineStart + (lastLine - firstLine) * lineWidth:][:(end - 1) % lineBases + 1]
+        if firstLine == lastLine:
+            tail = tail[start % lineBases:]
+            return tail if table is None else table[tail]
+        fullLines = lastLine - firstLine
+        lines = np.lib.stride_tricks.as_strided(self.buffer[lineStart:], shape=(fullLines, lineBases), strides=(lineWidth, 1), writeable=False)
+        region = np.empty(fullLines * lineBases + len(tail), dtype=np.uint8)
+        if table is None:
+            region[:fullLines * lineBases].reshape(fullLines, lineBases)[...] = lines
+            region[fullLines * lineBases:] = tail
+        else:
+            np.take(table, lines, out=region[:fullLines * lineBases].reshape(fullLines, lineBases), mode="clip")
+            region[fullLines * lineBases:] = table[tail]
+        return region[start % lineBases:]
+
+    # Raw (unchanged case) bytes of a region as a uint8 array
+    def fetch(self, name, start=0, end=None):
+        return self.region(name, start, end)
+
+    # 2-bit codes of a region, as encodeSequence would return them
+    def encode(self, name, start=0, end=None):
+        return self.region(name, start, end, BASE_CODES)
+
+# Same interface as FastaFile over Biopython's SeqIO.index, for formats and files FastaFile cannot map
+class IndexedSequences:
+    def __init__(self, path, sequenceFormat="fasta"):
+        self.path = path
+        self.sequenceFormat = sequenceFormat
+        self.index = SeqIO.index(path, sequenceFormat)
+        self.lengths = {}
+
+    def __getstate__(self):
+        return {"path": self.path, "sequenceFormat": self.sequenceFormat, "lengths": self.lengths}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index = SeqIO.index(self.path, self.sequenceFormat)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def length(self, name):
+        if name not in self.lengths:
+            self.lengths[name] = len(self.index[name])
+        return self.lengths[name]
+
+    def fetch(self, name, start=0, end=None):
+        return np.frombuffer(bytes(self.index[name].seq[start:end]), dtype=np.uint8)
+
+    def encode(self, name, start=0, end=None):
+        return BASE_CODES[self.fetch(name, start, end)]
+
+# Open a sequence file for random access: uncompressed FASTA is memory-mapped through a .fai index, anything else
+# (other formats, gzip/BGZF, FASTA with irregular line lengths) goes through SeqIO.index
+def openSequences(path, sequenceFormat="fasta"):
+    if sequenceFormat == "fasta":
+        with open(path, 'rb') as sequenceFile:
+            compressed = sequenceFile.read(2) == b'\x1f\x8b'
+        if not compressed:
+            try:
+                return FastaFile(path)
+            except ValueError as error:
+                logging.info(f"Could not index '{path}' for memory mapping ({error}), using SeqIO.index")
+    return IndexedSequences(path, sequenceFormat)
+
+# On-disk cache of counted (starts, ends, counts) blocks with one .npz entry per key. Entries are touched when used, and
+# the least recently used ones are evicted once the cache grows past maxBytes
+class BlockCache:
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+        # a run that only reads the cache never stores, so the size limit is also enforced on open
+        self.evict()
+
+    # Content-addressed key: a hash of the counting parameters and every piece (bytes or uint8 array) of a sequence
+    @staticmethod
+    def key(parameters, pieces):
+        digest = hashlib.blake2b(repr(tuple(parameters)).encode(), digest_size=20)
+        for piece in pieces:
+            digest.update(np.ascontiguousarray(piece))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    # Marks an entry as recently used, returning whether it exists
+    def touch(self, key):
+        try:
+            os.utime(self.path(key))
+            return True
+        except OSError:
+            return False
+
+    # Blocks stored under key, or None if there is no readable entry
+    def load(self, key):
+        try:
+            with np.load(self.path(key)) as entry:
+                if "counts" in entry:
+                    counts = entry["counts"]
+                else:
+                    counts = sparse.csr_matrix((entry["data"], entry["indices"], entry["indptr"]), shape=tuple(entry["shape"]))
+                blocks = [(entry["starts"], entry["ends"], counts)]
+        except (OSError, ValueError, KeyError):
+            return None
+        self.touch(key)
+        return blocks
+
+    def store(self, key, blocks):
+        if not blocks:
+            return
+        starts, ends, counts = concatenateBlocks(blocks)
+        arrays = {"starts": starts, "ends": ends}
+        if sparse.issparse(counts):
+            arrays.update(data=counts.data, indices=counts.indices, indptr=counts.indptr, shape=np.array(counts.shape))
+        else:
+            arrays["counts"] = counts
+        # written aside and renamed so a concurrent run never loads a partial entry
+        partial = f"{self.path(key)}.{os.getpid()}.partial"
+        with open(partial, 'wb') as entryFile:
+            np.savez(entryFile, **arrays)
+        os.replace(partial, self.path(key))
+        self.evict()
+
+    # Entries may be evicted at the same time by another run sharing the directory
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    status = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# Descriptor columns shared by every spectra table; all other columns are per-window measurements
+SPECTRA_DESCRIPTORS = ["Library", "Sequence", "Start", "End"]
+# Binary spectra store: magic, a (rows x columns) measurement matrix, one array per descriptor column (Library and
+# Sequence as uint32 category codes, Start and End as int64), then a JSON footer, its length and the magic again.
+# Arrays start on SPECTRA_ALIGN byte boundaries so each one can be memory-mapped directly
+SPECTRA_MAGIC = b"SPECTRA\x01"
+SPECTRA_ALIGN = 64
+SPECTRA_EXTENSION = ".spectra"
+# Spectra TSVs written to .gz paths are BGZF-compressed with a sidecar index of (Library, Sequence, Start, virtual
+# offset) checkpoints, taken at the first row of every sequence and every SPECTRA_INDEX_INTERVAL rows after it
+SPECTRA_INDEX_EXTENSION = ".sxi"
+SPECTRA_INDEX_INTERVAL = 256
+
+def isBinarySpectra(path):
+    if str(path).endswith(SPECTRA_EXTENSION):
+        return True
+    try:
+        with open(path, 'rb') as spectraFile:
+            return spectraFile.read(len(SPECTRA_MAGIC)) == SPECTRA_MAGIC
+    except OSError:
+        return False
+
+# Writes spectra rows as a tab-separated table
+class TsvSpectraWriter:
+    def __init__(self, path, columns, lineterminator='\r\n', **meta):
+        self.columns = list(columns)
+        self.lineterminator = lineterminator
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file, delimiter='\t', lineterminator=lineterminator)
+        self.writer.writerow(SPECTRA_DESCRIPTORS + self.columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    # Writes windows of one sequence: headers (e.g. [Library, Sequence]), then Start, End and one row of counts each
+    def writeBlock(self, headers, starts, ends, counts):
+        for start, end, row in zip(np.asarray(starts).tolist(), np.asarray(ends).tolist(), np.asarray(counts).tolist()):
+            self.writer.writerow(headers + [start, end] + row)
+
+    def writeFrame(self, spectra):
+        spectra[SPECTRA_DESCRIPTORS + self.columns].to_csv(self.file, sep='\t', index=False, header=False, lineterminator=self.lineterminator)
+
+    def close(self):
+        self.file.close()
+
+# Writes spectra rows as a BGZF-compressed TSV with a region index, so readSpectraRegion can seek to a sequence or
+# coordinate range without decompressing the whole file
+class BgzfSpectraWriter(TsvSpectraWriter):
+    def __init__(self, path, columns, lineterminator='\r\n', **meta):
+        self.columns = list(columns)
+        self.lineterminator = lineterminator
+        self.path = path
+        self.file = bgzf.BgzfWriter(path, 'wb')
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter='\t', lineterminator=lineterminator)
+        self.checkpoints = []
+        self.lastKey = None
+        self.sinceCheckpoint = 0
+        self.writer.writerow(SPECTRA_DESCRIPTORS + self.columns)
+        self.flushBuffer()
+
+    def flushBuffer(self):
+        self.file.write(self.buffer.getvalue().encode())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    # Records a checkpoint before rows starting at (library, sequence, start) when they start a sequence or an interval
+    def checkpoint(self, library, sequence, start, rows=1):
+        key = (str(library), str(sequence))
+        if key != self.lastKey or self.sinceCheckpoint >= SPECTRA_INDEX_INTERVAL:
+            self.flushBuffer()
+            self.checkpoints.append([key[0], key[1], int(start), self.file.tell()])
+            self.lastKey = key
+            self.sinceCheckpoint = 0
+        self.sinceCheckpoint += rows
+
+    def writerow(self, row):
+        self.checkpoint(row[0], row[1], row[len(row) - len(self.columns) - 2])
+        self.writer.writerow(row)
+        if self.buffer.tell() >= 1 << 16:
+            self.flushBuffer()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def writeBlock(self, headers, starts, ends, counts):
+        for start, end, row in zip(np.asarray(starts).tolist(), np.asarray(ends).tolist(), np.asarray(counts).tolist()):
+            self.writerow(headers + [start, end] + row)
+
+    def writeFrame(self, spectra):
+        spectra = spectra[SPECTRA_DESCRIPTORS + self.columns]
+        libraries, sequences, starts = spectra['Library'].astype(str).to_numpy(), spectra['Sequence'].astype(str).to_numpy(), spectra['Start'].to_numpy()
+        changes = np.flatnonzero((libraries[1:] != libraries[:-1]) | (sequences[1:] != sequences[:-1])) + 1
+        for first, last in zip(np.append(0, changes), np.append(changes, len(spectra))):
+            for segment in range(first, last, SPECTRA_INDEX_INTERVAL):
+                rows = min(SPECTRA_INDEX_INTERVAL, last - segment)
+                self.checkpoint(libraries[segment], sequences[segment], starts[segment], rows)
+                spectra.iloc[segment:segment + rows].to_csv(self.buffer, sep='\t', index=False, header=False, lineterminator=self.lineterminator)
+                self.flushBuffer()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flushBuffer()
+        self.file.close()
+        self.file = None
+        with open(f"{self.path}{SPECTRA_INDEX_EXTENSION}", 'w', newline='') as indexFile:
+            indexWriter = csv.writer(indexFile, delimiter='\t')
+            indexWriter.writerow(["Library", "Sequence", "Start", "Offset"])
+            indexWriter.writerows(self.checkpoints)
+
+# Writes spectra rows to the binary spectra store. The measurement matrix is streamed to disk as rows arrive; only the
+# descriptor columns are held until close. meta (mer_size, canonical, width, spacing, ...) is kept in the footer.
+# The store only replaces path on close, so a memory-mapped copy of path can be rewritten safely
+class BinarySpectraWriter:
+    def __init__(self, path, columns, dtype="uint32", lineterminator=None, **meta):
+        self.columns = list(columns)
+        self.dtype = np.dtype(dtype)
+        self.meta = meta
+        self.path = path
+        self.file = open(f"{path}.partial", 'wb')
+        self.file.write(SPECTRA_MAGIC.ljust(SPECTRA_ALIGN, b'\0'))
+        self.categories = {"Library": {}, "Sequence": {}}
+        self.descriptors = {descriptor: [] for descriptor in SPECTRA_DESCRIPTORS}
+        self.pending = []
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    # a block that fails partway leaves no store behind rather than a complete-looking truncated one
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self.file.closed:
+            self.file.close()
+            os.remove(self.file.name)
+
+    def categoryCodes(self, descriptor, names):
+        categories = self.categories[descriptor]
+        return np.array([categories.setdefault(name, len(categories)) for name in names], dtype=np.uint32)
+
+    def append(self, libraries, sequences, starts, ends, counts):
+        counts = np.ascontiguousarray(counts, dtype=self.dtype)
+        if counts.ndim != 2 or counts.shape[1] != len(self.columns):
+            raise ValueError(f"Expected {len(self.columns)} measurement columns, got {counts.shape}")
+        self.descriptors["Library"].append(self.categoryCodes("Library", libraries))
+        self.descriptors["Sequence"].append(self.categoryCodes("Sequence", sequences))
+        self.descriptors["Start"].append(np.asarray(starts, dtype=np.int64))
+        self.descriptors["End"].append(np.asarray(ends, dtype=np.int64))
+        self.file.write(counts.data)
+        self.rows += len(counts)
+
+    # rows in the TSV layout; anything between Library and Start is joined back into the sequence name
+    def flushRows(self):
+        if self.pending:
+            rows, self.pending = self.pending, []
+            split = len(rows[0]) - len(self.columns)
+            self.append([row[0] for row in rows], ["_".join(str(a) for a in row[1:split - 2]) for row in rows],
+                        [row[split - 2] for row in rows], [row[split - 1] for row in rows], [row[split:] for row in rows])
+
+    def writerow(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= 4096:
+            self.flushRows()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def writeBlock(self, headers, starts, ends, counts):
+        self.flushRows()
+        count = len(starts)
+        self.append([headers[0]] * count, ["_".join(headers[1:])] * count, starts, ends, counts)
+
+    def writeFrame(self, spectra):
+        self.flushRows()
+        self.append(spectra['Library'].astype(str), spectra['Sequence'].astype(str), spectra['Start'], spectra['End'], spectra[self.columns].to_numpy())
+
+    def align(self):
+        self.file.write(b'\0' * (-self.file.tell() % SPECTRA_ALIGN))
+        return self.file.tell()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flushRows()
+        footer = dict(self.meta, version=1, rows=self.rows, columns=self.columns, dtype=self.dtype.str, arrays={"counts": SPECTRA_ALIGN})
+        for descriptor, arrays in self.descriptors.items():
+            footer["arrays"][descriptor] = self.align()
+            array = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64 if descriptor in ("Start", "End") else np.uint32)
+            self.file.write(array.data)
+        footer["libraries"] = list(self.categories["Library"])
+        footer["sequences"] = list(self.categories["Sequence"])
+        footer = json.dumps(footer).encode()
+        self.file.write(footer + struct.pack("<Q", len(footer)) + SPECTRA_MAGIC)
+        self.file.close()
+        os.replace(self.file.name, self.path)
+
+# Open a spectra writer for path: the binary store for .spectra paths, an indexed BGZF TSV for .gz paths, otherwise a TSV
+def openSpectraWriter(path, columns, **meta):
+    if str(path).endswith(SPECTRA_EXTENSION):
+        return BinarySpectraWriter(path, columns, **meta)
+    if str(path).endswith(".gz"):
+        return BgzfSpectraWriter(path, columns, **meta)
+    return TsvSpectraWriter(path, columns, **meta)
+
+# Footer of a binary spectra store
+def readSpectraMeta(path):
+    with open(path, 'rb') as spectraFile:
+        spectraFile.seek(-8 - len(SPECTRA_MAGIC), os.SEEK_END)
+        footerLength = struct.unpack("<Q", spectraFile.read(8))[0]
+        if spectraFile.read(len(SPECTRA_MAGIC)) != SPECTRA_MAGIC:
+            raise ValueError(f"'{path}' is not a complete spectra file")
+        spectraFile.seek(-8 - len(SPECTRA_MAGIC) - footerLength, os.SEEK_END)
+        return json.loads(spectraFile.read(footerLength))
+
+# Long-layout counts (mer sizes above DENSE_MAX_MER) have a Mer/Count row per k-mer instead of a column per k-mer, which
+# the spectra readers cannot use
+def checkDenseLayout(columns, path):
+    if "Mer" in columns and "Count" in columns:
+        raise ValueError(f"'{path}' has long-layout counts (one Mer/Count row per k-mer, written by count for mer sizes above {DENSE_MAX_MER}), which other subcommands cannot read")
+
+# Read a spectra table from a TSV or a binary spectra store. Binary measurements are memory-mapped copy-on-write, and
+# the footer metadata is kept in spectra.attrs['spectra']
+def readSpectra(path):
+    return next(iterSpectra(path))
+
+# Read a spectra table chunkRows rows at a time (all at once if chunkRows is None), as readSpectra would read it
+def iterSpectra(path, chunkRows=None):
+    if not isBinarySpectra(path):
+        checkDenseLayout(pd.read_csv(path, delimiter='\t', nrows=0).columns, path)
+        if chunkRows is None:
+            yield pd.read_csv(path, delimiter='\t')
+        else:
+            yield from pd.read_csv(path, delimiter='\t', chunksize=chunkRows)
+        return
+    meta = readSpectraMeta(path)
+    rows, arrays = meta["rows"], meta["arrays"]
+    def mapped(name, dtype, shape):
+        if not rows:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='c', offset=arrays[name], shape=shape)
+    counts = mapped("counts", np.dtype(meta["dtype"]), (rows, len(meta["columns"])))
+    libraryCodes, sequenceCodes = mapped("Library", np.uint32, rows), mapped("Sequence", np.uint32, rows)
+    starts, ends = mapped("Start", np.int64, rows), mapped("End", np.int64, rows)
+    libraries, sequences = np.array(meta["libraries"], dtype=object), np.array(meta["sequences"], dtype=object)
+    chunkRows = chunkRows if chunkRows else max(rows, 1)
+    for first in range(0, max(rows, 1), chunkRows):
+        last = min(first + chunkRows, rows)
+        spectra = pd.DataFrame(counts[first:last], columns=meta["columns"], index=pd.RangeIndex(first, last), copy=False)
+        spectra.insert(0, "Library", libraries[libraryCodes[first:last]] if rows else [])
+        spectra.insert(1, "Sequence", sequences[sequenceCodes[first:last]] if rows else [])
+        spectra.insert(2, "Start", np.asarray(starts[first:last]))
+        spectra.insert(3, "End", np.asarray(ends[first:last]))
+        spectra.attrs["spectra"] = {key: value for key, value in meta.items() if key not in ("arrays", "libraries", "sequences", "columns", "rows", "dtype")}
+        yield spectra
+
+# Smallest binary store dtype holding every measurement: uint32 counts, int64 for other integers, float64 otherwise
+def spectraDtype(spectra):
+    values = spectra[[a for a in spectra.columns if a not in SPECTRA_DESCRIPTORS]].to_numpy()
+    if not np.issubdtype(values.dtype, np.integer):
+        return "float64"
+    return "uint32" if values.size == 0 or (values.min() >= 0 and values.max() < 2 ** 32) else "int64"
+
+# Write a spectra table to path as TSV, as an indexed BGZF TSV for .gz paths, or to the binary store for .spectra paths
+def writeSpectra(spectra, path, **meta):
+    if not str(path).endswith((SPECTRA_EXTENSION, ".gz")):
+        spectra.to_csv(path, sep='\t', index=False)
+        return
+    columns = [a for a in spectra.columns if a not in SPECTRA_DESCRIPTORS]
+    meta = dict(spectra.attrs.get("spectra", {}), **meta)
+    with openSpectraWriter(path, columns, dtype=spectraDtype(spectra), **meta) as writer:
+        writer.writeFrame(spectra)
+
+# Rows of spectra on the given sequences (any, if None) with windows inside start..end (unbounded if None)
+def filterSpectraRegion(spectra, sequences=None, start=None, end=None):
+    if sequences is not None:
+        spectra = spectra.loc[spectra['Sequence'].isin(sequences)]
+    if start is not None:
+        spectra = spectra.loc[spectra['Start'] >= start]
+    if end is not None:
+        spectra = spectra.loc[spectra['End'] <= end]
+    return spectra
+
+# Read only the rows of a spectra table on the given sequences with windows inside start..end. Indexed BGZF TSVs are read
+# from the last checkpoint before start in each matching run of rows, binary stores are filtered on their memory-mapped descriptors, and
+# other TSVs are read whole and filtered
+def readSpectraRegion(path, sequences=None, start=None, end=None):
+    if isBinarySpectra(path) or not os.path.exists(f"{path}{SPECTRA_INDEX_EXTENSION}"):
+        return filterSpectraRegion(readSpectra(path), sequences, start, end)
+    index = pd.read_csv(f"{path}{SPECTRA_INDEX_EXTENSION}", delimiter='\t', dtype={"Library": str, "Sequence": str})
+    keys = (index['Library'] + '\t' + index['Sequence']).to_numpy()
+    runStarts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    runEnds = np.append(runStarts[1:], len(index))
+    with bgzf.BgzfReader(path, 'rb') as spectraFile:
+        header = spectraFile.readline()
+        columns = header.decode().rstrip('\r\n').split('\t')
+        checkDenseLayout(columns, path)
+        startColumn = columns.index("Start")
+        lines = [header]
+        for first, last in zip(runStarts, runEnds):
+            if sequences is not None and index['Sequence'][first] not in sequences:
+                continue
+            checkpoint = first
+            if start is not None:
+                checkpoint = max(first, first + np.searchsorted(index['Start'].to_numpy()[first:last], start) - 1)
+            spectraFile.seek(int(index['Offset'][checkpoint]))
+            key = keys[first].encode()
+            for line in spectraFile:
+                fields = line.split(b'\t', startColumn + 1)
+                if b'\t'.join(fields[:2]) != key or (end is not None and int(fields[startColumn]) > end):
+                    break
+                lines.append(line)
+    return filterSpectraRegion(pd.read_csv(io.BytesIO(b''.join(lines)), delimiter='\t'), sequences, start, end)
+
+# Join consecutive (starts, ends, counts) blocks into one
+def concatenateBlocks(blocks):
+    starts, ends, counts = zip(*blocks)
+    counts = sparse.vstack(counts, format='csr') if sparse.issparse(counts[0]) else np.vstack(counts)
+    return np.concatenate(starts), np.concatenate(ends), counts
+
+# Sum every factor consecutive windows of a (starts, ends, counts) block into one coarser window. Aggregated windows do
+# not count the k-mers that span the joins between their base windows
+def aggregateWindows(starts, ends, counts, factor=2):
+    if len(starts) == 0:
+        return starts, ends, counts
+    firsts = np.arange(0, len(starts), factor)
+    if sparse.issparse(counts):
+        rows = np.arange(len(starts))
+        blocks = sparse.csr_matrix((np.ones(len(starts), dtype=counts.dtype), (rows // factor, rows)), shape=(len(firsts), len(starts)))
+        summed = (blocks @ counts).tocsr()
+    else:
+        summed = np.add.reduceat(counts, firsts, axis=0)
+    return starts[firsts], np.maximum.reduceat(ends, firsts), summed
+
+# Sum every factor consecutive windows of each sequence in a spectra table into one coarser window, keeping row order
+def aggregateSpectra(spectra, factor=2):
+    if factor <= 1 or len(spectra) == 0:
+        return spectra
+    spectra = spectra.reset_index(drop=True)
+    libraries, sequences = spectra['Library'].to_numpy(), spectra['Sequence'].to_numpy()
+    runStart = np.concatenate(([True], (libraries[1:] != libraries[:-1]) | (sequences[1:] != sequences[:-1])))
+    runFirst = np.maximum.accumulate(np.where(runStart, np.arange(len(spectra)), 0))
+    firsts = np.flatnonzero((np.arange(len(spectra)) - runFirst) % factor == 0)
+    columns = [a for a in spectra.columns if a not in SPECTRA_DESCRIPTORS]
+    aggregated = spectra.iloc[firsts].reset_index(drop=True)
+    aggregated['End'] = np.maximum.reduceat(spectra['End'].to_numpy(), firsts)
+    aggregated[columns] = np.add.reduceat(spectra[columns].to_numpy(), firsts, axis=0)
+    if "spectra" in spectra.attrs:
+        meta = spectra.attrs["spectra"]
+        aggregated.attrs["spectra"] = dict(meta, **{key: meta[key] * factor for key in ("width", "spacing") if key in meta})
+    return aggregated
+
+# Pyramid level paths sit next to the base table, e.g. spectra.x4.tsv holds spectra.tsv aggregated 4 windows at a time
+def pyramidPath(path, factor):
+    root, extension = os.path.splitext(path)
+    if extension == ".gz":
+        root, innerExtension = os.path.splitext(root)
+        extension = innerExtension + extension
+    return f"{root}.x{factor}{extension}"
+
+# Whether the level next to path was written with it: no earlier than path, starting at the same first window, with
+# windows factor times as wide and, for binary stores, factor times the recorded width and spacing. Levels left over
+# from another count run do not match
+def pyramidLevelMatches(path, factor):
+    levelPath = pyramidPath(path, factor)
+    if os.path.getmtime(levelPath) < os.path.getmtime(path):
+        return False
+    base, level = spectraHead(path), spectraHead(levelPath)
+    firstWindow = ["Library", "Sequence", "Start"]
+    if len(base) != 0 and (len(level) == 0 or base[firstWindow].iloc[0].astype(str).tolist() != level[firstWindow].iloc[0].astype(str).tolist()):
+        return False
+    if spectraWidth(levelPath, level) != factor * spectraWidth(path, base):
+        return False
+    if isBinarySpectra(path) and isBinarySpectra(levelPath):
+        base, level = readSpectraMeta(path), readSpectraMeta(levelPath)
+        return all(level.get(key) == factor * base[key] for key in ("width", "spacing") if base.get(key))
+    return True
+
+# Aggregation factors available next to path: 1, then 2, 4, 8, ... while the level exists and matches path
+def pyramidLevels(path):
+    levels = [1]
+    while os.path.exists(pyramidPath(path, levels[-1] * 2)):
+        if not pyramidLevelMatches(path, levels[-1] * 2):
+            logging.info(f"Ignoring pyramid level {pyramidPath(path, levels[-1] * 2)}, which was not written with {path}")
+            break
+        levels.append(levels[-1] * 2)
+    return levels
+
+# Removes the pyramid levels next to path above the first keep levels, with their region indexes
+def removePyramidLevels(path, keep=0):
+    factor = 2 ** (keep + 1)
+    while os.path.exists(pyramidPath(path, factor)):
+        os.remove(pyramidPath(path, factor))
+        if os.path.exists(f"{pyramidPath(path, factor)}{SPECTRA_INDEX_EXTENSION}"):
+            os.remove(f"{pyramidPath(path, factor)}{SPECTRA_INDEX_EXTENSION}")
+        factor *= 2
+
+# First SPECTRA_HEAD_ROWS rows of a spectra table
+SPECTRA_HEAD_ROWS = 1000
+def spectraHead(path):
+    if isBinarySpectra(path):
+        return next(iterSpectra(path, SPECTRA_HEAD_ROWS))
+    return pd.read_csv(path, delimiter='\t', nrows=SPECTRA_HEAD_ROWS)
+
+# Window width of a spectra table, from the widest of its first rows (windows of a sequence shorter than the width are
+# narrower). head is spectraHead(path) when already read
+def spectraWidth(path, head=None):
+    head = spectraHead(path) if head is None else head
+    return int((head['End'] - head['Start']).max() + 1) if len(head) else 1
+
+# Read path aggregated factor windows at a time, from the coarsest pyramid level dividing factor and aggregating the rest
+def readSpectraLevel(path, factor=1, sequences=None, start=None, end=None):
+    level = max(a for a in pyramidLevels(path) if max(factor, 1) % a == 0)
+    if level > 1:
+        logging.info(f"Reading pyramid level {pyramidPath(path, level)}")
+    spectra = readSpectraRegion(pyramidPath(path, level) if level > 1 else path, sequences, start, end)
+    return aggregateSpectra(spectra, factor // level)
+
+# Read path with windows aggregated to about resolution bases (base windows if resolution is None)
+def readSpectraResolution(path, resolution=None, sequences=None, start=None, end=None):
+    factor = max(1, resolution // spectraWidth(path)) if resolution else 1
+    return readSpectraLevel(path, factor, sequences, start, end)
+
 # Calculate breakpoints from spectra
 # For 64 literal counts, a penalty of 1,000,000 is ideal, but for frequencies a penalty of 0.5 is ideal
-def getBreakpoints(spectra, index=4, dim=64, penalty=1000000, min_size=5):
+# Breakpoint detection methods: ruptures' KernelCPD, or L2 cost PELT, binary segmentation and coarse-to-fine PELT
+BREAKPOINT_BACKENDS = ["kernel", "pelt", "binseg", "coarse"]
+
+# Groups are fitted in a multiprocessing pool when one is given, largest first, and returned in groupby order.
+# backend is one of BREAKPOINT_BACKENDS; coarse_factor is the number of windows summed by the coarse backend
+def getBreakpoints(spectra, index=4, dim=64, penalty=1000000, min_size=5, pool=None, backend="kernel", coarse_factor=8):
+    return getBreakpointPath(spectra, [penalty], index, dim, min_size, pool, backend, coarse_factor)[0]
+
+# Breakpoints of every group for each of penalties, as one getBreakpoints result per penalty. Each group is fitted once
+# and the fitted state (cumulative sums, searched binseg splits) is reused across penalties
+def getBreakpointPath(spectra, penalties, index=4, dim=64, min_size=5, pool=None, backend="kernel", coarse_factor=8):
     spectra = spectra.groupby(['Library', 'Sequence'])
-    output = []
-    # for each grouping, calculate rupture breakpoints, then convert them to starting window indices
-    for group in spectra:
-        data = group[1].iloc[0:len(group[1]), index:index + dim].to_numpy()
-        if len(data) > min_size * 2:
-            dataAlgo = rpt.KernelCPD(min_size=min_size).fit(data).predict(pen=penalty)
-            output.append((group[0], group[1].iloc[[a-1 for a in dataAlgo], 2:3]['Start'].tolist()))
+    tasks = [(group[0], group[1].iloc[0:len(group[1]), index:index + dim].to_numpy(), group[1]['Start'].to_numpy(), list(penalties), min_size, backend, coarse_factor) for group in spectra]
+    if pool is None:
+        results = dict(groupBreakpoints(task) for task in tasks)
+    else:
+        results = dict(pool.imap_unordered(groupBreakpoints, sorted(tasks, key=lambda task: len(task[1]), reverse=True)))
+    return [[(task[0], results[task[0]][position]) for task in tasks] for position in range(len(penalties))]
+
+# Calculate breakpoints of one getBreakpointPath task for each of its penalties, then convert them to window starts
+def groupBreakpoints(task):
+    group, data, starts, penalties, min_size, backend, coarse_factor = task
+    if len(data) <= min_size * 2:
+        return group, [[] for penalty in penalties]
+    if backend == "kernel":
+        algo = rpt.KernelCPD(min_size=min_size).fit(data)
+        path = [algo.predict(pen=penalty) for penalty in penalties]
+    else:
+        sums, splits = cumulativeSums(data), {}
+        if backend == "pelt":
+            path = [peltBreakpoints(data, penalty, min_size, sums) for penalty in penalties]
+        elif backend == "binseg":
+            path = [binsegBreakpoints(data, penalty, min_size, sums, splits) for penalty in penalties]
         else:
-            output.append((group[0], []))
-    return output
+            path = [coarseBreakpoints(data, penalty, min_size, coarse_factor, sums) for penalty in penalties]
+    return group, [starts[[a-1 for a in dataAlgo]].tolist() for dataAlgo in path]
+
+# Cumulative sums of windows and of their squared norms, from which any segment's L2 cost takes O(dim)
+def cumulativeSums(data):
+    data = np.asarray(data, dtype=float)
+    sums = np.zeros((len(data) + 1, data.shape[1]))
+    np.cumsum(data, axis=0, out=sums[1:])
+    squares = np.zeros(len(data) + 1)
+    np.cumsum((data * data).sum(axis=1), out=squares[1:])
+    return sums, squares
+
+# L2 cost (squared distance of every window to the segment mean) of segments starts..ends, for arrays of either
+def segmentCosts(sums, squares, starts, ends):
+    deltas = sums[ends] - sums[starts]
+    return squares[ends] - squares[starts] - (deltas * deltas).sum(axis=-1) / (ends - starts)
+
+# Split of start..end (within low..high) with the largest L2 cost reduction, as (split, gain), or (None, 0)
+def bestSplit(sums, squares, start, end, min_size, low=0, high=None):
+    high = end if high is None else high
+    splits = np.arange(max(start + min_size, low), min(end - min_size, high) + 1)
+    if len(splits) == 0:
+        return None, 0
+    gains = segmentCosts(sums, squares, start, end) - segmentCosts(sums, squares, start, splits) - segmentCosts(sums, squares, splits, end)
+    best = np.argmax(gains)
+    return int(splits[best]), gains[best]
+
+# Optimal segmentation under an L2 cost plus penalty per segment, by pruned exact linear time (PELT) dynamic programming.
+# Returns segment ends like ruptures' predict, the last being len(data). sums are the cumulativeSums of data, if known
+def peltBreakpoints(data, penalty, min_size=5, sums=None):
+    sums, squares = sums if sums is not None else cumulativeSums(data)
+    windows = len(data)
+    best = np.full(windows + 1, np.inf)
+    best[0] = -penalty
+    previous = np.zeros(windows + 1, dtype=np.int64)
+    candidates = np.array([0])
+    expiry = np.array([windows + 1])
+    for end in range(min_size, windows + 1):
+        if end - min_size >= min_size:
+            candidates = np.append(candidates, end - min_size)
+            expiry = np.append(expiry, windows + 1)
+        keep = expiry > end
+        candidates, expiry = candidates[keep], expiry[keep]
+        costs = best[candidates] + segmentCosts(sums, squares, candidates, end) + penalty
+        choice = np.argmin(costs)
+        best[end], previous[end] = costs[choice], candidates[choice]
+        # a start that is already worse than the best segmentation ending at end can never become optimal again once
+        # end can be the last breakpoint, min_size windows later
+        worse = costs - penalty > best[end]
+        expiry[worse] = np.minimum(expiry[worse], end + min_size)
+    ends = [windows]
+    while previous[ends[-1]] > 0:
+        ends.append(int(previous[ends[-1]]))
+    return sorted(ends)
+
+# Binary segmentation: split segments at their best L2 split while it lowers the cost by more than penalty.
+# splits caches the best split of each searched segment, so later calls with another penalty only search new segments
+def binsegBreakpoints(data, penalty, min_size=5, sums=None, splits=None):
+    sums, squares = sums if sums is not None else cumulativeSums(data)
+    splits = {} if splits is None else splits
+    ends = [len(data)]
+    segments = [(0, len(data))]
+    while segments:
+        start, end = segments.pop()
+        if (start, end) not in splits:
+            splits[start, end] = bestSplit(sums, squares, start, end, min_size)
+        split, gain = splits[start, end]
+        if split is not None and gain > penalty:
+            ends.append(split)
+            segments += [(start, split), (split, end)]
+    return sorted(ends)
 
-# Use breakpoints to append as bin column to spectra
+# Coarse-to-fine segmentation: PELT over the means of factor windows at a time (where a change in mean costs factor times
+# less, so the penalty is scaled to match), then each breakpoint is moved to the best split within factor windows of it
+# and kept if that split still lowers the cost by more than penalty
+def coarseBreakpoints(data, penalty, min_size=5, factor=8, sums=None):
+    windows = len(data)
+    firsts = np.arange(0, windows, factor)
+    coarse = np.add.reduceat(np.asarray(data, dtype=float), firsts, axis=0) / np.diff(np.append(firsts, windows))[:, None]
+    coarseEnds = [a * factor for a in peltBreakpoints(coarse, penalty / factor, max(1, min_size // factor))[:-1]]
+    sums, squares = sums if sums is not None else cumulativeSums(data)
+    ends = [0]
+    for position, end in enumerate(coarseEnds):
+        following = coarseEnds[position + 1] if position + 1 < len(coarseEnds) else windows
+        split, gain = bestSplit(sums, squares, ends[-1], following, min_size, end - factor, end + factor)
+        if split is not None and gain > penalty:
+            ends.append(split)
+    return ends[1:] + [windows]
+
+
+# Use breakpoints to append as bin column to spectra. A window joins the bin of the first breakpoint after its start if it
+# also ends before that breakpoint, windows from the last breakpoint on join the last bin and windows spanning a
+# breakpoint are left without a bin
 def applyBreakpoints(spectra, breakpoints):
-    for bkp in breakpoints:
-        breakCount = 0
-        index = 1
-        breakName = ''
-        if bkp[1]:
-            for bkpStart in bkp[1]:
-                breakName = f'{bkp[0][0]}_{bkp[0][1]}_{breakCount:02d}'
-                indices = list(spectra.loc[(spectra['Library'] == bkp[0][0]) & (spectra['Sequence'] == bkp[0][1]) & (
-                        spectra['Start'] >= index) & (spectra['End'] < bkpStart)].index)
-                spectra.loc[indices, 'Block'] = breakName
-                index = bkpStart
-                breakCount += 1
-            indices = list(spectra.loc[(spectra['Library'] == bkp[0][0]) & (spectra['Sequence'] == bkp[0][1]) & (
-                        spectra['Start'] >= index)].index)
-            spectra.loc[indices, 'Block'] = breakName
-        else:
-            breakName = f'{bkp[0][0]}_{bkp[0][1]}_{breakCount:02d}'
-            indices = list(spectra.loc[(spectra['Library'] == bkp[0][0]) & (spectra['Sequence'] == bkp[0][1])].index)
-            spectra.loc[indices, 'Block'] = breakName
+    blocks = spectra['Block'].to_numpy(dtype=object) if 'Block' in spectra.columns else np.full(len(spectra), np.nan, dtype=object)
+    groups = spectra.groupby(['Library', 'Sequence']).indices
+    starts, ends = spectra['Start'].to_numpy(), spectra['End'].to_numpy()
+    for group, bkps in breakpoints:
+        rows = groups[group]
+        names = np.array([f'{group[0]}_{group[1]}_{breakCount:02d}' for breakCount in range(max(len(bkps), 1))], dtype=object)
+        if not bkps:
+            blocks[rows] = names[0]
+            continue
+        bkps = np.asarray(bkps)
+        bins = np.searchsorted(bkps, starts[rows], side='right')
+        last = bins == len(bkps)
+        inside = ~last & (starts[rows] >= np.append(1, bkps)[bins]) & (ends[rows] < bkps[np.minimum(bins, len(bkps) - 1)])
+        blocks[rows[inside]] = names[bins[inside]]
+        blocks[rows[last]] = names[-1]
+    spectra['Block'] = blocks
     return spectra
 
-def getBreakpointFrequencies(spectra, frequency, index=4, dim=64):
-    spectra = spectra.groupby(['Block', 'Library', 'Sequence'])
-    outputs = pd.DataFrame()
-    for group in spectra:
-        frequencies = getGlobalFrequencies(group[1], frequency, index=index, dim=dim)
-        outputs.loc[len(outputs.index), ['Library', 'Sequence', 'Bin', 'Length', 'Start', 'End'] + list(frequencies.keys())] = [group[0][1], group[0][2], str(group[0][0]), str(max(group[1]['End']) - min(group[1]['Start']) + 1), str(min(group[1]['Start'])), str(max(group[1]['End']))] + list(frequencies.values())
-    return outputs
+# Length, coordinates and frequencies of every bin of spectra, in one grouped reduction. Frequencies are per k-mer position
+# like getGlobalFrequencies, or per window with frequency
+def getBreakpointFrequencies(spectra, frequency, index=4, dim=64, merLen=None):
+    columns = list(spectra.columns[index:index + dim])
+    merLen = merLen if merLen else len(columns[0])
+    groups = spectra.assign(Positions=spectra['End'] - spectra['Start'] - (merLen - 2)).groupby(['Block', 'Library', 'Sequence'])
+    sums = groups[columns + ['Positions']].sum()
+    bins = groups.agg(Start=('Start', 'min'), End=('End', 'max'), Windows=('Start', 'size'))
+    frequencies = sums[columns].div(bins['Windows'] if frequency else sums['Positions'], axis=0)
+    outputs = pd.DataFrame({'Library': bins.index.get_level_values('Library'), 'Sequence': bins.index.get_level_values('Sequence'),
+                            'Bin': bins.index.get_level_values('Block').astype(str), 'Length': (bins['End'] - bins['Start'] + 1).astype(str).to_numpy(),
+                            'Start': bins['Start'].astype(str).to_numpy(), 'End': bins['End'].astype(str).to_numpy()})
+    return pd.concat([outputs, frequencies.reset_index(drop=True)], axis=1)
 
 # Transform spectra counts to spectra frequencies
-def countToFrequency(spectra, index=4, dim=64, merLen=3):
-    for column in range(index,index+dim):
-        spectra[spectra.columns[column]] = spectra[spectra.columns[column]].astype("float")
-    for rowIndex, row in spectra.iterrows():
-        denominator = row['End'] - row['Start'] - (merLen - 2)
-        spectra.iloc[rowIndex, index:index + dim] = spectra.iloc[rowIndex, index:index + dim] / denominator
+# Each window is divided by its number of k-mer positions; merLen defaults to the length of the first k-mer column
+def countToFrequency(spectra, index=4, dim=64, merLen=None):
+    columns = spectra.columns[index:index + dim]
+    merLen = merLen if merLen else len(columns[0])
+    denominator = (spectra['End'] - spectra['Start'] - (merLen - 2)).to_numpy(dtype="float")
+    frequencies = spectra[columns].to_numpy(dtype="float") / denominator[:, None]
+    spectra[columns] = pd.DataFrame(frequencies, index=spectra.index, columns=columns)
     return spectra
 
-# Transform spectra counts to spectra frequencies
-def frequencyToCount(spectra, index=4, dim=64, merLen=3):
+# Transform spectra frequencies back to spectra counts, undoing countToFrequency
+def frequencyToCount(spectra, index=4, dim=64, merLen=None):
+    columns = spectra.columns[index:index + dim]
+    merLen = merLen if merLen else len(columns[0])
+    denominator = (spectra['End'] - spectra['Start'] - (merLen - 2)).to_numpy(dtype="float")
+    counts = np.rint(spectra[columns].to_numpy(dtype="float") * denominator[:, None]).astype(np.int64)
+    spectra[columns] = pd.DataFrame(counts, index=spectra.index, columns=columns)
     return spectra
 
 # Calculate global frequencies across spectra
-def getGlobalFrequencies(spectra, frequency=False, index=4, dim=64):
+def getGlobalFrequencies(spectra, frequency=False, index=4, dim=64, merLen=None):
+    return getChunkedGlobalFrequencies([spectra], frequency, index, dim, merLen)
+
+# Calculate global frequencies across chunks of spectra (e.g. from iterSpectra) in fixed memory
+def getChunkedGlobalFrequencies(chunks, frequency=False, index=4, dim=64, merLen=None):
+    columns, counts, rows, positions = None, 0, 0, 0
+    for spectra in chunks:
+        columns = spectra.columns[index:index + dim]
+        merLen = merLen if merLen else len(columns[0])
+        counts = counts + spectra[columns].to_numpy().sum(axis=0)
+        rows += len(spectra)
+        positions += (spectra['End'] - spectra['Start']).sum() - len(spectra) * (merLen - 2)
     if frequency:
-        return dict(zip(spectra.columns[index:index + dim], np.array(spectra.iloc[0:len(spectra), index:index + dim].sum()/len(spectra))))
+        return dict(zip(columns, counts / rows))
     else:
-        counts = np.array(spectra.sum())
-        return dict(zip(spectra.columns[index:index + dim], np.divide(counts[index:index + dim], counts[3] - counts[2] - len(spectra.Library))))
+        return dict(zip(columns, np.divide(counts, positions)))
 
-# Reduce frequencies from a given set of global frequencies
-def reduceFrequencies():
-    return
+# Reduce counts to their rounded relative deviation from the counts expected from a given set of global frequencies,
+# over the k-mer positions of one window (the first window of spectra unless positions is given)
+def reduceFrequencies(spectra, frequencies, merLen=None, positions=None):
+    mers = list(frequencies)
+    merLen = merLen if merLen else len(mers[0])
+    if positions is None:
+        positions = spectra['End'].iloc[0] - spectra['Start'].iloc[0] - (merLen - 2)
+    expected = positions * np.array([frequencies[a] for a in mers])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reduced = np.round((spectra[mers].to_numpy() - expected) / expected)
+    spectra[mers] = pd.DataFrame(reduced.astype(np.int64) if np.isfinite(reduced).all() else reduced, index=spectra.index, columns=mers)
+    return spectra
 
 # needs work. Currently does nothing
 def spectraRC(spectra, index=4, dim=64, merLen=3):